@@ -0,0 +1,200 @@
+import array, operator
+
+# Array values of lgl_interpreter.py: sequences of integers that the arithmetic operations apply to element by
+# element, so a computation over a whole range is a single operation instead of one call per number.
+# The elements are stored as 64-bit integers in a NumPy array if NumPy is installed, otherwise in an array.array.
+# Like the other integers of GSC they never overflow: elements that do not fit into 64 bits are stored in a list
+# of Python integers instead, which is slower but gives the same results with and without NumPy.
+# Arrays never change once they are created, every operation returns a new one.
+
+TYPECODE = 'q' # Signed 64-bit integers in array.array, the same as numpy.int64
+LIMIT = 2 ** 63 - 1 # Largest magnitude that is stored in 64 bits (-2 ** 63 is stored as a list as well)
+SHOWN_ELEMENTS = 6 # Larger arrays are shown with '...' instead of the elements in the middle
+
+numpy = None # Imported by load_numpy() when the first array is created, so programs without arrays start faster
+numpy_loaded = False
+
+def load_numpy():
+    global numpy, numpy_loaded
+    if not numpy_loaded:
+        try:
+            import numpy as module
+        except ImportError: # The array module is used instead, which is slower but needs no installation
+            module = None
+        numpy, numpy_loaded = module, True
+    return numpy
+
+class Array:
+    __slots__ = ('data',)
+    __hash__ = None # Not hashable, so memoized functions do not keep large arrays alive
+
+    def __init__(self, data):
+        self.data = data # A NumPy array, an array.array or a list of Python integers, see store()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return (int(value) for value in self.data)
+
+    def __str__(self):
+        if len(self) <= SHOWN_ELEMENTS:
+            return f'[{", ".join(map(str, self))}]'
+        half = SHOWN_ELEMENTS // 2
+        shown = [int(value) for value in self.data[:half]] + ['...'] + [int(value) for value in self.data[-half:]]
+        return f'[{", ".join(map(str, shown))}]'
+
+    def __repr__(self):
+        return f'Array({self})'
+
+    def __add__(self, other):
+        return elementwise(operator.add, self, other)
+
+    def __radd__(self, other):
+        return elementwise(operator.add, other, self)
+
+    def __sub__(self, other):
+        return elementwise(operator.sub, self, other)
+
+    def __rsub__(self, other):
+        return elementwise(operator.sub, other, self)
+
+    def __mul__(self, other):
+        return elementwise(operator.mul, self, other)
+
+    def __rmul__(self, other):
+        return elementwise(operator.mul, other, self)
+
+    def __floordiv__(self, other):
+        assert not has_zero(other), "Error: division by 0"
+        return elementwise(operator.floordiv, self, other)
+
+    def __rfloordiv__(self, other):
+        assert not has_zero(self), "Error: division by 0"
+        return elementwise(operator.floordiv, other, self)
+
+    def __pow__(self, other):
+        assert not has_negative(other), "Error: negative power of an integer array"
+        return elementwise(operator.pow, self, other)
+
+    def __rpow__(self, other):
+        assert not has_negative(self), "Error: negative power of an integer array"
+        return elementwise(operator.pow, other, self)
+
+    def __abs__(self):
+        if is_numpy(self.data) and magnitude(self) <= LIMIT:
+            return Array(numpy.abs(self.data))
+        return Array(store(list(map(abs, self))))
+
+def elementwise(function, left, right):
+    # Either operand may be an integer, which is applied to every element of the other one
+    if not is_operand(left) or not is_operand(right):
+        return NotImplemented
+    if isinstance(left, Array) and isinstance(right, Array):
+        assert len(left) == len(right), f"Arrays of different lengths: {len(left)} and {len(right)}"
+    # NumPy computes in 64 bits, so it is only used if no result can be larger than that
+    if numpy is not None and is_vector(left) and is_vector(right) and FITS[function](magnitude(left), magnitude(right)):
+        return Array(function(unwrap(left), unwrap(right)))
+    if not isinstance(right, Array):
+        values = [function(value, right) for value in left]
+    elif not isinstance(left, Array):
+        values = [function(left, value) for value in right]
+    else:
+        values = list(map(function, left, right))
+    return Array(store(values))
+
+def fits_power(base, exponent):
+    if base <= 1:
+        return True
+    # The bit length is checked first, so a huge power is never computed just to find out that it does not fit
+    return exponent * (base.bit_length() - 1) < 64 and base ** exponent <= LIMIT
+
+# {operation: whether every result fits into 64 bits, given the largest magnitudes of the two operands}
+FITS = {
+    operator.add: lambda left, right: left + right <= LIMIT,
+    operator.sub: lambda left, right: left + right <= LIMIT,
+    operator.mul: lambda left, right: left * right <= LIMIT,
+    operator.floordiv: lambda left, right: left <= LIMIT, # The divisor is never 0
+    operator.pow: fits_power,
+}
+
+def store(values):
+    # The fastest storage for a list of Python integers that can hold all of them
+    if load_numpy() is not None:
+        if not values or (min(values) >= -LIMIT and max(values) <= LIMIT):
+            return numpy.array(values, dtype=numpy.int64)
+        return values
+    try:
+        return array.array(TYPECODE, values)
+    except OverflowError:
+        return values
+
+def is_operand(value):
+    return isinstance(value, (int, Array))
+
+def is_numpy(data):
+    return numpy is not None and isinstance(data, numpy.ndarray)
+
+def is_vector(value):
+    # An integer or an array whose elements are in a NumPy array
+    return is_numpy(value.data) if isinstance(value, Array) else -LIMIT <= value <= LIMIT
+
+def magnitude(value):
+    # The largest absolute value of an integer or of the elements of an array, as a Python integer
+    if not isinstance(value, Array):
+        return abs(value)
+    data = value.data
+    if len(data) == 0:
+        return 0
+    if is_numpy(data):
+        return max(-int(data.min()), int(data.max()))
+    return max(-min(data), max(data))
+
+def unwrap(value):
+    return value.data if isinstance(value, Array) else value
+
+def has_zero(value):
+    if not isinstance(value, Array):
+        return value == 0
+    if is_numpy(value.data):
+        return not value.data.all()
+    return 0 in value.data
+
+def has_negative(value):
+    if not isinstance(value, Array):
+        return isinstance(value, int) and value < 0
+    return len(value) > 0 and array_min(value) < 0
+
+def make_array(*values):
+    # ["array", 1, 2, 3]
+    assert all(isinstance(value, int) for value in values), "Array elements must be integers"
+    return Array(store(list(values)))
+
+def make_range(*bounds):
+    # ["range", stop], ["range", start, stop] or ["range", start, stop, step], like range() in Python
+    assert 1 <= len(bounds) <= 3, "Expected 1 to 3 arguments: [start,] stop [, step]"
+    assert all(isinstance(bound, int) for bound in bounds), "The bounds of a range must be integers"
+    assert len(bounds) < 3 or bounds[2] != 0, "Error: range step of 0"
+    if load_numpy() is not None and all(-LIMIT <= bound <= LIMIT for bound in bounds):
+        return Array(numpy.arange(*bounds, dtype=numpy.int64))
+    return Array(store(list(range(*bounds))))
+
+def array_sum(value):
+    data = checked(value, 'sum').data
+    if is_numpy(data) and len(data) * magnitude(value) <= LIMIT:
+        return int(data.sum())
+    return sum(map(int, data))
+
+def array_min(value):
+    data = checked(value, 'min').data
+    assert len(data) > 0, "Error: min of an empty array"
+    return int(data.min() if is_numpy(data) else min(data))
+
+def array_max(value):
+    data = checked(value, 'max').data
+    assert len(data) > 0, "Error: max of an empty array"
+    return int(data.max() if is_numpy(data) else max(data))
+
+def checked(value, operation):
+    assert isinstance(value, Array), f"{operation} expects an array, got {type(value).__name__}: {value}"
+    return value
@@ -0,0 +1,293 @@
+import time
+STARTED = time.perf_counter() # The startup time of a measurement includes importing the interpreter
+
+import argparse, json, os, subprocess, sys, tempfile
+from lgl_interpreter import (
+    BACKENDS, TraceSink, Metrics, create_metadata, install_metrics, install_program, prepare_program
+)
+
+try:
+    import resource
+except ImportError: # Not available on Windows, the peak memory is not measured there
+    resource = None
+
+# Benchmark suite of lgl_interpreter.py: generates programs of a given size, runs every program with every
+# backend (with and without a trace) in a fresh Python process and reports the operations per second, the
+# run time, the startup time and the peak memory. The results can be stored as a baseline, later runs are
+# compared against it and every measurement that got worse by more than the threshold is reported.
+
+DEPTH = 60 # Depth of deep_recursion, the tree-walker reaches the Python recursion limit at about 140
+
+##############################################
+################# WORKLOADS ##################
+##############################################
+
+# Every generator returns a program whose run time grows linearly with `size`
+
+def deep_recursion(size):
+    # `size` recursive descents of DEPTH calls each
+    return [
+        'sequence',
+        ['set', 'down', ['function', ['n'],
+            ['if', ['get', 'n'], ['add', 1, ['call', 'down', ['substract', ['get', 'n'], 1]]], 0]
+        ]],
+        *[['call', 'down', DEPTH] for _ in range(size)],
+    ]
+
+def wide_sequence(size):
+    # One sequence with `size` steps at the top level
+    return [
+        'sequence',
+        ['set', 'x', 0],
+        ['set', 'y', 3],
+        *[['set', 'x', ['add', ['get', 'x'], ['substract', ['get', 'y'], i % 7]]] for i in range(size)],
+        ['absolute', ['get', 'x']],
+    ]
+
+def nested_closures(size):
+    # `size` calls of the nested functions of example_scoping.gsc, which read and set outer variables
+    return [
+        'sequence',
+        ['set', 'do_my_multiplication', ['function', ['a', 'b'], ['multiplication', ['get', 'a'], ['get', 'b']]]],
+        ['set', 'outer_func', ['function', 'x', ['sequence',
+            ['set', 'middle_func', ['function', 'y', ['sequence',
+                ['set', 'x', ['add', ['get', 'x'], 10]],
+                ['set', 'inner_func', ['function', [], ['call', 'do_my_multiplication', ['get', 'x'], ['get', 'y']]]],
+                ['call', 'inner_func'],
+            ]]],
+            ['call', 'middle_func', 3],
+        ]]],
+        *[['call', 'outer_func', i] for i in range(size)],
+    ]
+
+def infix_heavy(size):
+    # `size` calls of a function like the one of example_infix.gsc, whose body is mostly infix strings
+    return [
+        'sequence',
+        ['set', 'calculate', ['function', ['x', 'y', 'z'], ['sequence',
+            ['set', 'result1', "['['['get', 'x'] * 20'] / 15 '] + ['['get', 'y'] + 23']"],
+            ['set', 'result2', "['get', 'x'] - ['get', 'z']"],
+            ['set', 'result3', "['get', 'y'] * ['get', 'z']"],
+            ['set', 'result4', "['['get', 'result3'] * 100']/ ['['add', ['get', 'x'], 2] + 2']"],
+            ['set', 'logic_xor', "['get', 'result2'] xor ['get', 'result3']"],
+            "['get', 'result1'] + ['get', 'result4']",
+        ]]],
+        *[['call', 'calculate', i, i % 5 + 1, 2] for i in range(size)],
+    ]
+
+# {name: (generator, default size)}, the default sizes take about a tenth of a second with the tree-walker
+WORKLOADS = {
+    'deep_recursion': (deep_recursion, 100),
+    'wide_sequence': (wide_sequence, 20000),
+    'nested_closures': (nested_closures, 1500),
+    'infix_heavy': (infix_heavy, 1500),
+}
+
+def count_operations(program):
+    # Number of operations (and infix strings) the tree-walker evaluates, the work done by every backend
+    metadata = create_metadata()
+    program = install_program(prepare_program(json.dumps(program)), metadata)
+    metrics = Metrics()
+    restore = install_metrics(metrics)
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit, 20000)) # The measuring wrappers add Python frames to every operation
+    try:
+        BACKENDS['tree'](program, metadata)
+    except Exception:
+        return None
+    finally:
+        sys.setrecursionlimit(limit)
+        restore()
+    return sum(operation['count'] for operation in metrics.summary()['operations'].values())
+
+##############################################
+################ MEASUREMENT #################
+##############################################
+
+def measure(code_file, backend, repeat, traced):
+    # Runs in its own process, so the peak memory and the caches belong to this measurement only
+    with open(code_file) as f:
+        prepared = prepare_program(f.read())
+    startup = time.perf_counter() - STARTED
+    times = []
+    for _ in range(repeat):
+        tracer = TraceSink(code_file + '.trace') if traced else None
+        metadata = create_metadata(tracer)
+        program = install_program(prepared, metadata)
+        start = time.perf_counter()
+        try:
+            result = BACKENDS[backend](program, metadata)
+        finally:
+            if tracer:
+                tracer.close() # Writing the rest of the trace is part of the run
+        times.append(time.perf_counter() - start)
+    return {
+        'result': str(result),
+        'run_ms': min(times) * 1000,
+        'startup_ms': startup * 1000,
+        'peak_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None,
+    }
+
+def measure_main(argv):
+    # benchmark.py measure CODE_FILE BACKEND REPEAT [--trace], prints the measurement as JSON
+    code_file, backend, repeat = argv[:3]
+    try:
+        measurement = measure(code_file, backend, int(repeat), '--trace' in argv[3:])
+    except Exception as e:
+        measurement = {'error': f'{type(e).__name__}: {e}'}
+    print(json.dumps(measurement))
+
+def run_case(code_file, backend, repeat, traced):
+    command = [sys.executable, os.path.abspath(__file__), 'measure', code_file, backend, str(repeat)]
+    completed = subprocess.run(command + (['--trace'] if traced else []), capture_output=True, text=True)
+    if completed.returncode != 0:
+        lines = completed.stderr.strip().splitlines()
+        return {'error': lines[-1] if lines else f'exit code {completed.returncode}'}
+    return json.loads(completed.stdout.splitlines()[-1])
+
+def run_suite(workloads, backends, modes, scale, repeat, directory):
+    results = {}
+    for name in workloads:
+        generator, size = WORKLOADS[name]
+        program = generator(max(1, int(size * scale)))
+        code_file = os.path.join(directory, name + '.gsc')
+        with open(code_file, 'w') as f:
+            json.dump(program, f)
+        operations = count_operations(program)
+        for backend in backends:
+            for traced in modes:
+                case = f'{name}/{backend}' + ('/traced' if traced else '')
+                measurement = run_case(code_file, backend, repeat, traced)
+                if 'run_ms' in measurement and operations:
+                    measurement['ops'] = operations
+                    measurement['ops_per_sec'] = operations / max(measurement['run_ms'] / 1000, 1e-9)
+                results[case] = measurement
+                print(format_row(case, measurement), flush=True)
+    return results
+
+##############################################
+################## BASELINE ##################
+##############################################
+
+# Compared measurements: {name: True if a higher value is better}
+COMPARED = {
+    'ops_per_sec': True,
+    'startup_ms': False,
+    'peak_kb': False,
+}
+
+def find_regressions(results, baseline, threshold):
+    # Returns (case, description) for every measurement that is worse than in the baseline by more than threshold
+    regressions = []
+    for case, current in results.items():
+        previous = baseline['cases'].get(case)
+        if previous is None:
+            continue
+        if 'error' in current and 'error' not in previous:
+            regressions.append((case, f"fails now: {current['error']}"))
+            continue
+        if 'result' in previous and current.get('result') != previous['result']:
+            regressions.append((case, f"result changed: {previous['result']} -> {current.get('result')}"))
+        for metric, higher_is_better in COMPARED.items():
+            old, new = previous.get(metric), current.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append((case, f'{metric} {change:+.1%} ({old:.1f} -> {new:.1f})'))
+    return regressions
+
+def read_baseline(baseline_file, scale):
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    if baseline.get('scale') != scale:
+        print(f"Warning: the baseline was measured with --scale {baseline.get('scale')}, not {scale}")
+    return baseline
+
+def write_baseline(baseline_file, results, scale):
+    with open(baseline_file, 'w') as f:
+        json.dump({'python': sys.version.split()[0], 'scale': scale, 'cases': results}, f, indent=2)
+
+##############################################
+################### OUTPUT ###################
+##############################################
+
+HEADER = f'{"Case":<34}{"ops/sec":>12}{"run (ms)":>12}{"startup (ms)":>14}{"peak (MB)":>12}'
+
+def format_row(case, measurement):
+    if 'error' in measurement:
+        return f'{case:<34}  FAILED {measurement["error"]}'
+    ops = f'{measurement["ops_per_sec"]:,.0f}' if 'ops_per_sec' in measurement else '-'
+    peak = f'{measurement["peak_kb"] / 1024:.1f}' if measurement['peak_kb'] else '-'
+    return f'{case:<34}{ops:>12}{measurement["run_ms"]:>12.1f}{measurement["startup_ms"]:>14.1f}{peak:>12}'
+
+##############################################
+################ MAIN FUNCTION ###############
+##############################################
+
+def main():
+    if sys.argv[1:2] == ['measure']: # Started by run_case() for every measurement
+        return measure_main(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the backends of lgl_interpreter.py on generated programs.',
+        epilog='Example usage: python benchmark.py --baseline benchmark_baseline.json'
+    )
+    parser.add_argument(
+        '--workloads', default=','.join(WORKLOADS),
+        help=f'Comma-separated workloads to run (default: all of {", ".join(WORKLOADS)})'
+    )
+    parser.add_argument(
+        '--backends', default=','.join(BACKENDS),
+        help=f'Comma-separated backends to run (default: all of {", ".join(BACKENDS)})'
+    )
+    parser.add_argument(
+        '--trace', choices=['both', 'off', 'on'], default='both',
+        help='Run without a trace, with a trace or both (default)'
+    )
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiply the sizes of the workloads')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement, the fastest one is reported')
+    parser.add_argument('--baseline', metavar='FILE', help='Compare the results against this baseline')
+    parser.add_argument('--save-baseline', metavar='FILE', help='Store the results as a baseline')
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='Relative change of a measurement that is reported as a regression (default: 0.1)'
+    )
+    parser.add_argument('--workload-dir', metavar='DIR', help='Keep the generated programs in this directory')
+    args = parser.parse_args()
+
+    workloads = args.workloads.split(',')
+    backends = args.backends.split(',')
+    for name in workloads:
+        if name not in WORKLOADS:
+            parser.error(f"Unknown workload: {name}")
+    for backend in backends:
+        if backend not in BACKENDS:
+            parser.error(f"Unknown backend: {backend}")
+    if args.baseline and not os.path.exists(args.baseline):
+        parser.error(
+            f"No baseline {args.baseline}, measure one first with: python benchmark.py --save-baseline {args.baseline}"
+        )
+    modes = {'both': (False, True), 'off': (False,), 'on': (True,)}[args.trace]
+    baseline = read_baseline(args.baseline, args.scale) if args.baseline else None
+
+    print(HEADER)
+    if args.workload_dir:
+        os.makedirs(args.workload_dir, exist_ok=True)
+        results = run_suite(workloads, backends, modes, args.scale, args.repeat, args.workload_dir)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            results = run_suite(workloads, backends, modes, args.scale, args.repeat, directory)
+
+    if args.save_baseline:
+        write_baseline(args.save_baseline, results, args.scale)
+    if baseline is not None:
+        regressions = find_regressions(results, baseline, args.threshold)
+        for case, description in regressions:
+            print(f'REGRESSION | {case} | {description}')
+        print(f'BASELINE | {len(regressions)} regressions beyond {args.threshold:.0%} in {len(results)} cases')
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
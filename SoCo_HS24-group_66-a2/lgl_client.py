@@ -0,0 +1,115 @@
+import argparse, json, os, socket, sys
+from concurrent.futures import ThreadPoolExecutor
+from trace_format import TRACE_WRITERS, WALL_CLOCK, open_trace
+
+# Client of lgl_interpreter.py serve: sends programs to the server over its Unix socket and prints the results.
+# It only imports the standard library and trace_format.py, so it starts much faster than the interpreter.
+# Requests and responses are JSON objects, one per line, and a connection may send several requests:
+#   request:  {"path": "/abs/code.gsc"} or {"program": ["sequence", ...]}
+#             optional "backend": "stack" and "trace": true or {"include": "fib*", "exclude": "...",
+#             "sample": "1/10", "depth": 3}, like the options of lgl_interpreter.py
+#   response: {"result": 42, "functions": ["fib"], "run_ms": 0.3}
+#             or {"error": "ZeroDivisionError: ...", "functions": [...], "run_ms": ...} if the program failed
+#             or {"error": "ProgramError: ...", "invalid": [["$[1]", "message"], ...]} if it is not valid
+#             with "trace": [[call_id, timestamp_ns, function_name, event, parent_id or 0], ...] and
+#             "sample_rate": N if a trace was requested
+
+DEFAULT_SOCKET = 'lgl_server.sock'
+
+def send_request(socket_path, request):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        with connection.makefile('rwb') as stream:
+            stream.write(json.dumps(request).encode() + b'\n')
+            stream.flush()
+            line = stream.readline()
+    if not line:
+        raise ConnectionError(f"The server on {socket_path} closed the connection without a response")
+    return json.loads(line)
+
+def make_request(program, args):
+    # A path is sent as an absolute path, since the server may run in another directory
+    if program == '-':
+        request = {'program': json.load(sys.stdin)}
+    else:
+        request = {'path': os.path.abspath(program)}
+    if args.backend:
+        request['backend'] = args.backend
+    if args.trace_file:
+        selection = {
+            'include': args.trace_include, 'exclude': args.trace_exclude,
+            'sample': args.trace_sample, 'depth': args.trace_depth,
+        }
+        request['trace'] = {key: value for key, value in selection.items() if value is not None} or True
+    return request
+
+def response_lines(response):
+    # The same lines as lgl_interpreter.py prints for a single program
+    if 'invalid' in response:
+        return [f'INVALID PROGRAM | {path} | {message}' for path, message in response['invalid']]
+    lines = []
+    if 'functions' in response:
+        lines.append('USER-DEFINED FUNCTIONS | ' + ', '.join(response['functions']))
+    if 'error' in response:
+        lines.append(f'ERROR | {response["error"]}')
+    else:
+        lines.append(f'RESULT | {response["result"]}')
+    return lines
+
+def write_trace(response, trace_file, trace_format):
+    # The events of the server are written like a trace of lgl_interpreter.py --trace, their timestamps are
+    # already wall-clock times since they were read from a trace of the server
+    if trace_format == 'csv':
+        file = open_trace(trace_file, mode='wt', newline='')
+    else:
+        file = open_trace(trace_file, mode='wb')
+    with file:
+        writer = TRACE_WRITERS[trace_format](file, response.get('sample_rate', 1), WALL_CLOCK)
+        writer.write_batch([tuple(event) for event in response.get('trace', [])])
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run programs on a server started with lgl_interpreter.py serve.',
+        epilog='Example usage: python lgl_client.py code.gsc --trace trace_file.log'
+    )
+    parser.add_argument('programs', nargs='+', help='Paths to the code files, or - to read a program from stdin')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help=f'Path of the Unix socket (default: {DEFAULT_SOCKET})')
+    parser.add_argument('--backend', help='Backend used by the server (default: the one of the server)')
+    parser.add_argument(
+        '--jobs', type=int, default=os.cpu_count(),
+        help='Number of programs sent at once, each over its own connection (default: number of CPUs)'
+    )
+    parser.add_argument(
+        '--trace', dest='trace_file',
+        help='Write the trace of the program to this file (compressed if it ends with .gz or .xz)'
+    )
+    parser.add_argument('--trace-format', choices=TRACE_WRITERS.keys(), default='csv', help='Format of the trace file')
+    parser.add_argument('--trace-include', metavar='GLOB[,GLOB]', help='See lgl_interpreter.py --trace-include')
+    parser.add_argument('--trace-exclude', metavar='GLOB[,GLOB]', help='See lgl_interpreter.py --trace-exclude')
+    parser.add_argument('--trace-sample', metavar='1/N', help='See lgl_interpreter.py --trace-sample')
+    parser.add_argument('--trace-depth', metavar='N', type=int, help='See lgl_interpreter.py --trace-depth')
+    args = parser.parse_args()
+
+    if args.trace_file and len(args.programs) > 1:
+        parser.error("--trace can only be used with a single program")
+    if args.programs.count('-') > 1:
+        parser.error("Only one program can be read from stdin")
+
+    requests = [make_request(program, args) for program in args.programs]
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+            responses = list(executor.map(lambda request: send_request(args.socket, request), requests))
+    except (FileNotFoundError, ConnectionRefusedError):
+        sys.exit(f"No server is listening on {args.socket}, start one with: python lgl_interpreter.py serve")
+
+    for program, response in zip(args.programs, responses):
+        for line in response_lines(response):
+            # Several programs are printed like the batch mode, with the path in front of every line
+            print(f'{program} | {line}' if len(args.programs) > 1 else line)
+    if args.trace_file:
+        write_trace(responses[0], args.trace_file, args.trace_format)
+    if any('error' in response for response in responses):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,16 @@
-import argparse, json, re, ast, operator, csv
-from datetime import datetime
-import secrets
+import argparse, json, re, ast, operator, itertools, time, os, sys, threading, fnmatch
+from collections import OrderedDict
+from trace_format import TRACE_WRITERS, COMPRESSORS, BackgroundWriter, is_compressed, open_trace
+from trace_format import read_trace, read_sample_rate, trace_origin
+from array_values import make_array, make_range, array_sum, array_min, array_max
 
 ##############################################
 ################## SCOPES ####################
 ##############################################
 
+# Marks a slot of a scope that has not been assigned yet
+UNSET = object()
+
 class GlobalScope:
     def __init__(self):
         self.globals = {}
@@ -22,26 +27,373 @@ class GlobalScope:
     def __str__(self):
         return str(self.globals)
 
-GLOBAL_SCOPE = GlobalScope()
-
 class Scope:
-    def __init__(self, parent=None):
-        self.locals = {}
-        self.parent = parent if parent else GLOBAL_SCOPE
+    # The scope of one function call: the values live in a list and the layout,
+    # which is shared by every call of the same function, maps a name to its slot.
+    # Every call gets its own Scope, so recursive calls never share their variables.
+    __slots__ = ('layout', 'values', 'parent', 'extra', 'function')
+
+    def __init__(self, layout, parent=None, function=None):
+        self.layout = layout
+        self.values = [UNSET] * len(layout)
+        self.parent = parent # The scope the function was defined in, None for global functions
+        self.extra = None # Variables that were not known when the function was defined
+        self.function = function # The function object that is being called
+
+    def find(self, name):
+        # Looks the name up along the parent chain, without raising if it is missing
+        scope = self
+        while scope is not None:
+            slot = scope.layout.get(name)
+            if slot is not None and scope.values[slot] is not UNSET:
+                return scope.values[slot]
+            if scope.extra and name in scope.extra:
+                return scope.extra[name]
+            scope = scope.parent
+        return UNSET
 
     def get(self, name):
-        if name in self.locals:
-            return self.locals[name]
-        elif self.parent:
-            return self.parent.get(name)
-        else:
+        value = self.find(name)
+        if value is UNSET:
             raise NameError(f"Variable {name} not found")
+        return value
 
     def set(self, name, value):
-        self.locals[name] = value
+        slot = self.layout.get(name)
+        if slot is not None:
+            self.values[slot] = value
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[name] = value
 
     def __str__(self):
-        return str(self.locals)
+        local_vars = {name: self.values[slot] for name, slot in self.layout.items() if self.values[slot] is not UNSET}
+        return str({**local_vars, **(self.extra or {})})
+
+##############################################
+################# TRACING ####################
+##############################################
+
+class TraceSink:
+    # Keeps the trace file open for the whole run and writes the events in batches
+    def __init__(self, trace_file, trace_format='csv', batch_size=1000,
+                 include=(), exclude=(), sample_rate=1, max_depth=None):
+        # A file name ending with .gz or .xz is compressed, see trace_format.COMPRESSORS
+        if trace_format == 'csv':
+            self.file = open_trace(trace_file, mode='wt', newline='')
+        else:
+            self.file = open_trace(trace_file, mode='wb')
+        # The wall-clock times of the events are counted from the moment the sink was created
+        origin = trace_origin()
+        # A compressed trace is written by a separate thread, a plain one is written right away when it is flushed
+        if is_compressed(trace_file):
+            self.background = self.writer = BackgroundWriter(self.file, TRACE_WRITERS[trace_format], sample_rate, origin)
+        else:
+            self.background = None
+            self.writer = TRACE_WRITERS[trace_format](self.file, sample_rate, origin)
+        self.batch_size = batch_size
+        self.buffer = []
+        self.call_ids = itertools.count(1) # A counter is cheaper than random ids and never collides
+        self.open_calls = [] # Call IDs of the calls that are running, the last one is the caller of a new call
+
+        # Selective tracing, see start_selected()
+        self.include = include # Glob patterns of the traced function names, all of them if empty
+        self.exclude = exclude # Glob patterns of the function names that are never traced
+        self.sample_rate = sample_rate # Every function records one in `sample_rate` of its calls
+        self.max_depth = max_depth # Calls nested deeper than this are not traced
+        self.depth = 0 # Number of running calls, including the ones that are not traced
+        self.selected = {} # {function name: whether it matches the patterns}
+        self.counts = {} # {function name: number of calls that matched the patterns}
+        if include or exclude or sample_rate > 1 or max_depth is not None:
+            # A trace of every call keeps the plain start() and stop()
+            self.start, self.stop = self.start_selected, self.stop_selected
+
+    def start(self, func_name):
+        call_id = next(self.call_ids)
+        parent_id = self.open_calls[-1] if self.open_calls else 0
+        self.open_calls.append(call_id)
+        self.record(call_id, func_name, 'start', parent_id)
+        return call_id
+
+    def stop(self, call_id, func_name):
+        self.open_calls.pop()
+        parent_id = self.open_calls[-1] if self.open_calls else 0
+        self.record(call_id, func_name, 'stop', parent_id)
+
+    def start_selected(self, func_name):
+        # Decides whether a call is traced before it gets a call ID or a timestamp, so a call that is not traced
+        # only costs a few dictionary lookups. Returns 0 for such a call, which stop_selected() skips.
+        self.depth += 1
+        if self.max_depth is not None and self.depth > self.max_depth:
+            return 0
+        selected = self.selected.get(func_name)
+        if selected is None:
+            selected = self.selected[func_name] = is_traced(func_name, self.include, self.exclude)
+        if not selected:
+            return 0
+        if self.sample_rate > 1:
+            count = self.counts.get(func_name, 0)
+            self.counts[func_name] = count + 1
+            if count % self.sample_rate: # The 1st, (N+1)th, (2N+1)th... call of every function is traced
+                return 0
+        # The caller of a traced call is the nearest traced call that is running
+        return TraceSink.start(self, func_name)
+
+    def stop_selected(self, call_id, func_name):
+        self.depth -= 1
+        if call_id:
+            TraceSink.stop(self, call_id, func_name)
+
+    def record(self, call_id, func_name, event, parent_id):
+        self.buffer.append((call_id, time.perf_counter_ns(), func_name, event, parent_id))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.writer.write_batch(self.buffer)
+            # Every writer, also the BackgroundWriter, formats the events before write_batch() returns,
+            # so the list can be reused
+            self.buffer.clear()
+
+    def close(self):
+        if not self.file.closed:
+            try:
+                self.flush()
+                if self.background:
+                    self.background.close()
+            finally:
+                self.file.close()
+
+def is_traced(func_name, include, exclude):
+    if include and not any(fnmatch.fnmatchcase(func_name, pattern) for pattern in include):
+        return False
+    return not any(fnmatch.fnmatchcase(func_name, pattern) for pattern in exclude)
+
+def parse_sample_rate(text):
+    # --trace-sample 1/N (or just N)
+    numerator, _, denominator = text.rpartition('/')
+    try:
+        rate = int(denominator)
+    except ValueError:
+        rate = 0
+    if numerator not in ('', '1') or rate < 1:
+        raise argparse.ArgumentTypeError(f"expected 1/N with a positive integer N, got {text}")
+    return rate
+
+def parse_patterns(text):
+    # --trace-include and --trace-exclude take comma-separated glob patterns
+    return tuple(pattern for pattern in text.split(',') if pattern)
+
+def add_selection_arguments(parser):
+    # The options of selective tracing, shared by the single program and the batch mode
+    parser.add_argument(
+        '--trace-include', metavar='GLOB[,GLOB]', type=parse_patterns, default=(),
+        help='Only trace the functions whose names match one of the glob patterns (e.g., "fib*,calc_?")'
+    )
+    parser.add_argument(
+        '--trace-exclude', metavar='GLOB[,GLOB]', type=parse_patterns, default=(),
+        help='Never trace the functions whose names match one of the glob patterns'
+    )
+    parser.add_argument(
+        '--trace-sample', metavar='1/N', type=parse_sample_rate, default=1,
+        help='Trace one in N calls of every function, reporting.py scales the counts back up'
+    )
+    parser.add_argument(
+        '--trace-depth', metavar='N', type=int,
+        help='Only trace the calls nested at most N deep (1 traces the calls made at the top level)'
+    )
+
+def selection_options(args):
+    # Keyword arguments of TraceSink for the options of add_selection_arguments()
+    return {
+        'include': args.trace_include, 'exclude': args.trace_exclude,
+        'sample_rate': args.trace_sample, 'max_depth': args.trace_depth,
+    }
+
+##############################################
+############# SAMPLING PROFILER ##############
+##############################################
+
+class Sampler:
+    # Records the names of the running calls every `interval` seconds from a background thread, instead of
+    # an event per call. The samples are counted per call stack in memory and written as collapsed stacks.
+    TOP_LEVEL = '(top level)' # Stack of the samples taken while no function was running
+
+    def __init__(self, metadata, interval):
+        self.metadata = metadata
+        self.interval = interval
+        self.counts = {} # {(outermost name, ..., innermost name): number of samples}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='lgl-sampler', daemon=True)
+
+    def start(self):
+        # The pycompile backend only pushes frames for its calls while a sampler reads them
+        self.metadata['sampled'] = True
+        self.thread.start()
+
+    def run(self):
+        frames = self.metadata['frames']
+        counts = self.counts
+        while not self.stopped.wait(self.interval):
+            # The list is copied at once, the frames are only read afterwards
+            stack = tuple(frame.function['name'] for frame in frames[:]) or (self.TOP_LEVEL,)
+            counts[stack] = counts.get(stack, 0) + 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def write_collapsed(self, output_file):
+        # Example: outer;inner;deepHelper 12 (the same format as reporting.py --collapsed, with samples as values)
+        with open(output_file, 'w') as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write(f'{";".join(stack)} {count}\n')
+
+##############################################
+############### MEMOIZATION ##################
+##############################################
+
+class Memoizer:
+    # Caches the results of pure functions in a size-bounded LRU, keyed by the definition and the arguments.
+    # A function is pure if it only reads its parameters and the local variables it has already set,
+    # defines no functions and only calls pure functions.
+    def __init__(self, size=10000):
+        self.size = size
+        # {(serial of the function object, arguments): result}, oldest first. Not keyed by id(), which Python
+        # reuses for a function object defined after an older one was freed.
+        self.results = OrderedDict()
+        self.bodies = {} # {id of a body: (body, pure, names of the called functions)}
+        self.verdicts = {} # {id of a function object: (function object, pure)}
+        self.depends = {} # {serial of a pure function object: names of all functions it calls directly or indirectly}
+        self.hits = {}
+        self.misses = {}
+
+    def is_pure(self, func_data, functions):
+        verdict = self.verdicts.get(id(func_data))
+        if verdict is None:
+            names = set()
+            verdict = self.verdicts[id(func_data)] = (func_data, self.check_calls(func_data, functions, names, set()))
+            if verdict[1]:
+                self.depends[func_data['serial']] = names
+        return verdict[1]
+
+    def check_calls(self, func_data, functions, names, visiting):
+        # The functions are looked up by name when they are called, so the callees are checked against the
+        # functions defined right now. Recursive calls are assumed to be pure while the cycle is checked.
+        visiting.add(id(func_data))
+        pure, callees = self.analyze_body(func_data)
+        if not pure:
+            return False
+        for name in callees:
+            names.add(name)
+            callee = functions.get(name)
+            if callee is None:
+                return False
+            if id(callee) not in visiting and not self.check_calls(callee, functions, names, visiting):
+                return False
+        return True
+
+    def analyze_body(self, func_data):
+        body = func_data['body']
+        cached = self.bodies.get(id(body))
+        if cached is None or cached[0] is not body:
+            callees = set()
+            cached = self.bodies[id(body)] = (body, is_pure_expr(body, set(func_data['params']), callees), callees)
+        return cached[1], cached[2]
+
+    def lookup(self, func_name, key):
+        try:
+            result = self.results.get(key, UNSET)
+        except TypeError: # Arguments that cannot be hashed are never cached
+            return UNSET
+        if result is UNSET:
+            self.misses[func_name] = self.misses.get(func_name, 0) + 1
+        else:
+            self.hits[func_name] = self.hits.get(func_name, 0) + 1
+            self.results.move_to_end(key)
+        return result
+
+    def store(self, key, result):
+        try:
+            self.results[key] = result
+        except TypeError:
+            return
+        if len(self.results) > self.size:
+            self.results.popitem(last=False) # Evict the least recently used result
+
+    def forget(self, func_name, previous):
+        # Called when a function is defined. Only a redefinition can change the result of a call that was cached,
+        # but any definition can turn a call to a function that did not exist into a pure one.
+        # `previous` is the function object that is replaced, None for a new function.
+        self.verdicts.clear()
+        if previous is None:
+            return
+        stale = {serial for serial, names in self.depends.items() if func_name in names}
+        stale.add(previous['serial']) # Its results can never be looked up again
+        for key in [key for key in self.results if key[0] in stale]:
+            del self.results[key]
+        self.depends = {serial: names for serial, names in self.depends.items() if serial not in stale}
+
+    def report(self):
+        return ', '.join(
+            f'{name} (hits {self.hits.get(name, 0)}, misses {misses})' for name, misses in self.misses.items()
+        )
+
+def is_pure_expr(expr, assigned, callees):
+    # Walks the expression in evaluation order: a local variable may only be read after it was set,
+    # otherwise the lookup would fall back to an outer or global variable
+    if isinstance(expr, str):
+        try:
+            return is_pure_infix(parse_infix(expr), assigned, callees)
+        except (ValueError, SyntaxError):
+            return False
+    if not isinstance(expr, list) or not expr:
+        return True
+    if len(expr) == 1 and isinstance(expr[0], str):
+        return is_pure_expr(expr[0], assigned, callees)
+
+    operation = expr[0]
+    if operation == 'get':
+        return len(expr) == 2 and expr[1] in assigned
+    if operation == 'set':
+        if len(expr) != 3 or not isinstance(expr[1], str):
+            return False
+        value = expr[2]
+        if isinstance(value, list) and value and value[0] == 'function':
+            return False # Defining a function changes metadata['functions']
+        if not is_pure_expr(value, assigned, callees):
+            return False
+        assigned.add(expr[1])
+        return True
+    if operation == 'call':
+        if len(expr) < 2 or not isinstance(expr[1], str):
+            return False
+        callees.add(expr[1])
+        return all(is_pure_expr(item, assigned, callees) for item in expr[2:])
+    if operation in BRANCHES and len(expr) > 2:
+        # Only the first operand is always evaluated, a variable set in a branch is only known to be set
+        # afterwards if every branch sets it
+        if not is_pure_expr(expr[1], assigned, callees):
+            return False
+        branches = [set(assigned) for _ in expr[2:]]
+        if not all(is_pure_expr(item, branch, callees) for item, branch in zip(expr[2:], branches)):
+            return False
+        if operation == 'if':
+            assigned.update(set.intersection(*branches))
+        return True
+    return all(is_pure_expr(item, assigned, callees) for item in expr[1:])
+
+def is_pure_infix(node, assigned, callees):
+    kind = node[0]
+    if kind == 'get':
+        return node[1] in assigned
+    if kind == 'expr':
+        return is_pure_expr(node[1], assigned, callees)
+    if kind == 'operation':
+        return is_pure_infix(node[2], assigned, callees) and is_pure_infix(node[3], assigned, callees)
+    return True
 
 ##############################################
 ############### DECORATOR ####################
@@ -49,27 +401,18 @@ class Scope:
 
 def trace(func):
     def wrapper(args, metadata):
-        func_name = args[0]  # Get the specific function name from arguments
+        tracer = metadata['tracer']
+        # If tracing is disabled, just call the function
+        if tracer is None:
+            return func(args, metadata)
 
-        # If trace file is provided, write the function call event to the file
-        if metadata['trace_file']:
-            call_id = secrets.token_hex(3) # Generate a unique call ID for each function call
-            start_time = datetime.now() # Get the current timestamp
-            # Write the function call event to the trace file
-            with open(metadata['trace_file'], mode="a", newline="") as f:
-                writer = csv.writer(f)
-                writer.writerow([call_id, start_time, func_name, "start"])
-
-        # Call the function and get the result
-        result = func(args, metadata)
-
-        if metadata['trace_file']:
-            end_time = datetime.now() # Get the current timestamp
-            with open(metadata['trace_file'], mode="a", newline="") as f:
-                writer = csv.writer(f)
-                writer.writerow([call_id, end_time, func_name, "stop"])
-        # Return the result of the function call
-        return result
+        func_name = args[0]  # Get the specific function name from arguments
+        call_id = tracer.start(func_name) # Record the function call event
+        try:
+            # Call the function and return its result
+            return func(args, metadata)
+        finally:
+            tracer.stop(call_id, func_name) # Also recorded if the call raised an error
     # Return the wrapper function
     return wrapper
 
@@ -77,48 +420,23 @@ def trace(func):
 ############# UTILITY FUNCTIONS ##############
 ##############################################
 
+# The arguments of the operations are checked by check_arguments() before they are evaluated, or only once
+# by validate_program() for a prepared program, see VALIDATION
 def do_set(args, metadata):
-    assert len(args) == 2, "Expected exactly 2 arguments: name and value"
-    assert isinstance(args[0], str), f"Variable name must be a string, got {type(args[0])}"
-
     keyword, value = args
 
     # Check if the value is a function definition
     if isinstance(value, list) and value[0] == 'function':
-        params = value[1]
-        if isinstance(params, str):
-            params = [params]
-        body = value[2]
-
-        # If we're already inside a function, create a nested function
-        if metadata['in_function']:
-            parent_func = metadata['in_function']
-            child_func = createFunctionObject(params, body, metadata['functions'][parent_func]['scope'])
-        # Otherwise, create a global function
-        else:
-            child_func = createFunctionObject(params, body)
-
-        # Store the function in the metadata
-        metadata['functions'][keyword] = child_func
-        return metadata['functions'][keyword]
+        return define_function(keyword, value, metadata)
 
     # Evaluate the value if it's an expression
     value = do(value, metadata)
-    
-    # If inside a function, set the variable in the function's scope
-    if metadata['in_function']:
-        func_name = metadata['in_function']
-        metadata['functions'][func_name]['scope'].set(keyword, value)
-    # Else we set the variable in the global scope
-    else:
-        metadata['globals'].set(keyword, value)
-    return value
+    return assign_variable(keyword, value, metadata)
 
 @trace
 def do_call(args, metadata):
-    assert len(args) >= 1, "Expected at least one argument"
-    assert isinstance(args[0], str), "First argument must be the function name"
-
+    # Same steps as invoke_function() of the other backends, but written out here: every Python frame of a
+    # call counts against the recursion limit, and the tree-walker already needs three per LGL call
     func_name = args[0]
     arguments = args[1:] if len(args) > 1 else []
 
@@ -127,54 +445,45 @@ def do_call(args, metadata):
 
     func_data = metadata['functions'][func_name]
     params = func_data['params']
-    body = func_data['body']
 
     if len(params) != len(arguments):
         raise TypeError(f"Function {func_name} expects {len(params)} arguments but got {len(arguments)}")
 
-    # Create a new scope for the function call with the caller's scope as its parent
-    call_scope = Scope(func_data['scope'])
-
-    # Set function arguments in this new local scope
-    for param_name, arg_value in zip(params, arguments):
-        evaluated_arg = do(arg_value, metadata)
-        call_scope.set(param_name, evaluated_arg)
-
-    # Temporarily switch the function’s scope to this new scope
-    original_scope = func_data['scope']
-    func_data['scope'] = call_scope
-
-    # If the function is called from another function, update the caller function name
-    caller_func = None
-    if metadata['in_function'] != func_name:
-        caller_func = metadata['in_function']
-
-    enter_function(func_name, metadata) # Enter the function
-    result = do(body, metadata) # Execute the function body
-    exit_function(metadata) # Exit the function
-
-    if caller_func: # Restore the caller function name in metadata
-        metadata['in_function'] = caller_func
+    # Create a new scope for the function call with the scope the function was defined in as its parent.
+    # The function object itself is never modified, so recursive and concurrent calls are safe
+    call_scope = Scope(func_data['layout'], func_data['env'], func_data)
+
+    # Set function arguments in this new local scope, they are evaluated in the scope of the caller
+    values = call_scope.values
+    for slot, arg_value in zip(func_data['param_slots'], arguments):
+        values[slot] = do(arg_value, metadata)
+
+    # A pure function that was already called with the same arguments is not executed again
+    key = None
+    memo = metadata['memo']
+    if memo is not None and memo.is_pure(func_data, metadata['functions']):
+        key = (func_data['serial'], tuple(values[slot] for slot in func_data['param_slots']))
+        result = memo.lookup(func_name, key)
+        if result is not UNSET:
+            return result
+
+    enter_function(call_scope, metadata) # Enter the function
+    try:
+        if func_data['native'] is not None: # Translated by the pycompile backend
+            result = func_data['native'](metadata, *[values[slot] for slot in func_data['param_slots']])
+        elif metadata['closures']: # Closure backend
+            result = execute_compiled(func_data, metadata)
+        else:
+            result = do(func_data['body'], metadata) # Execute the function body
+    finally:
+        exit_function(metadata) # Exit the function, also if the body raised an error
 
-    # Restore the original scope after execution
-    func_data['scope'] = original_scope
+    if key is not None:
+        memo.store(key, result)
     return result
 
 def do_get(args, metadata):
-    assert len(args) == 1, "Expected exactly 1 argument: name"
-    assert isinstance(args[0], str), f"Variable name must be a string, got {type(args[0])}"
-    keyword = args[0]
-
-    # Check active function scope first, then global
-    if metadata['in_function']:
-        active_func = metadata['in_function']
-        active_scope = metadata['functions'][active_func]['scope']
-        try:
-            return active_scope.get(keyword)
-        except NameError:
-            pass
-    
-    return metadata['globals'].get(keyword)
+    return lookup_variable(args[0], metadata)
 
 def do(expr, metadata):
     if isinstance(expr, int):
@@ -190,40 +499,207 @@ def do(expr, metadata):
         return evaluate_expression(expr[0], metadata)
     
     operation = expr[0]
-    if operation in OPS:
-        return OPS[operation](expr[1:], metadata)
-    else:
+    function = metadata['ops'].get(operation) # CHECKED_OPS, or OPS for a validated program
+    if function is None:
         raise ValueError(f"Unknown operation: {operation}")
+    return function(expr[1:], metadata)
     
 ##############################################
 ############# HELPER FUNCTIONS ###############
 ##############################################
 
-def createFunctionObject(params, body, parent=None):
+FUNCTION_SERIALS = itertools.count() # Every function object gets its own number, unlike id() it is never reused
+
+def createFunctionObject(params, body, layout, reads, parent=None, name=None):
     return {
+        'name': name, # Name the function was defined with, used by the sampling profiler
+        'serial': next(FUNCTION_SERIALS), # Identifies the definition in the keys of the Memoizer
         'params': params,
         'body': body,
-        'scope': Scope(parent),
+        'layout': layout, # {variable name: slot} of the scopes of the calls
+        'param_slots': [layout[param] for param in params],
+        'addresses': resolve_addresses(reads, layout, parent),
+        'env': parent, # Scope the function was defined in, None for global functions
+        'compiled': None, # Closure tree of the body, filled in by the closure backend on the first call
+        'native': None, # Python function generated from the body, filled in by the pycompile backend
     }
 
-def enter_function(func_name, metadata):
-    metadata['in_function'] = func_name
+def define_function(keyword, value, metadata):
+    params, body, layout, reads = analyze_function(value, metadata)
+
+    # If we're already inside a function, create a nested function
+    if metadata['frames']:
+        child_func = createFunctionObject(params, body, layout, reads, metadata['frames'][-1], keyword)
+    # Otherwise, create a global function
+    else:
+        child_func = createFunctionObject(params, body, layout, reads, name=keyword)
+
+    # The pycompile backend runs the function as Python code if its body can be translated
+    if metadata['native']:
+        factory = python_factory(value)
+        if factory is not None:
+            child_func['native'] = factory(child_func)
+
+    # Cached results that depend on an older definition of the function are no longer valid
+    if metadata['memo'] is not None:
+        metadata['memo'].forget(keyword, metadata['functions'].get(keyword))
+
+    # Store the function in the metadata
+    metadata['functions'][keyword] = child_func
+    return metadata['functions'][keyword]
+
+def analyze_function(value, metadata):
+    # The layout and the variables read by a ["function", params, body] node only depend on the node,
+    # so they are computed once per program even if the function is defined on every call of its parent
+    cached = metadata['analyzed'].get(id(value))
+    if cached and cached[0] is value:
+        return cached[1]
+
+    params = value[1]
+    if isinstance(params, str):
+        params = [params]
+    body = value[2]
+
+    layout = {}
+    for param in params:
+        layout.setdefault(param, len(layout))
+    reads = set()
+    collect_variables(body, layout, reads)
+
+    metadata['analyzed'][id(value)] = (value, (params, body, layout, reads))
+    return params, body, layout, reads
+
+def collect_variables(expr, layout, reads):
+    # Adds the variables set in `expr` to the layout and the variables read in `expr` to `reads`,
+    # without looking into nested functions, which are analyzed when they are defined
+    if isinstance(expr, str):
+        reads.update(GET_PATTERN.findall(expr)) # Variables used by infix expressions
+        return
+    if not isinstance(expr, list) or not expr:
+        return
+
+    operation = expr[0]
+    if operation == 'function':
+        return
+    if operation == 'get' and len(expr) == 2 and isinstance(expr[1], str):
+        reads.add(expr[1])
+        return
+    if operation == 'set' and len(expr) == 3 and isinstance(expr[1], str):
+        value = expr[2]
+        if isinstance(value, list) and value and value[0] == 'function':
+            return # Functions are stored in metadata['functions'], not in the scope
+        layout.setdefault(expr[1], len(layout))
+    for item in expr[1:]:
+        collect_variables(item, layout, reads)
+
+def resolve_addresses(reads, layout, parent):
+    # For every variable read by the function, the slots where it can live, innermost first:
+    # (None, slot) is a slot in the scope of the running call and (scope, slot) a slot in one of
+    # the scopes the function was defined in, which never change once the function exists.
+    # A variable that is set later in the function keeps falling back to the outer slots until then.
+    addresses = {}
+    for name in reads:
+        candidates = []
+        if name in layout:
+            candidates.append((None, layout[name]))
+        scope = parent
+        while scope is not None:
+            if name in scope.layout:
+                candidates.append((scope, scope.layout[name]))
+            scope = scope.parent
+        addresses[name] = tuple(candidates)
+    return addresses
+
+def assign_variable(keyword, value, metadata):
+    # If inside a function, set the variable in the scope of the running call
+    if metadata['frames']:
+        metadata['frames'][-1].set(keyword, value)
+    # Else we set the variable in the global scope
+    else:
+        metadata['globals'].set(keyword, value)
+    return value
+
+def lookup_variable(keyword, metadata):
+    # Check the scope of the active call and the scopes it was defined in first, then global.
+    # The slots of every variable the body reads are resolved when the function is defined (from the
+    # variables analyze_function() collected), so the lookup only reads them and never changes the function.
+    if metadata['frames']:
+        call_scope = metadata['frames'][-1]
+        for scope, slot in call_scope.function['addresses'].get(keyword, ()):
+            value = (scope or call_scope).values[slot]
+            if value is not UNSET:
+                return value
+
+        # Variables that were not known when the function was defined, e.g. set by an infix string
+        value = call_scope.find(keyword)
+        if value is not UNSET:
+            return value
+
+    return metadata['globals'].get(keyword)
+
+def invoke_function(func_name, arguments, evaluate, execute, metadata):
+    # The call of the closure backend: `evaluate` turns one argument into a value and
+    # `execute` runs the body of the function object
+    if func_name not in metadata['functions']:
+        raise NameError(f"Function {func_name} not found")
+
+    func_data = metadata['functions'][func_name]
+    params = func_data['params']
+
+    if len(params) != len(arguments):
+        raise TypeError(f"Function {func_name} expects {len(params)} arguments but got {len(arguments)}")
+
+    # Create a new scope for the function call with the scope the function was defined in as its parent.
+    # The function object itself is never modified, so recursive and concurrent calls are safe
+    call_scope = Scope(func_data['layout'], func_data['env'], func_data)
+
+    # Set function arguments in this new local scope, they are evaluated in the scope of the caller
+    values = call_scope.values
+    for slot, arg_value in zip(func_data['param_slots'], arguments):
+        values[slot] = evaluate(arg_value, metadata)
+
+    # A pure function that was already called with the same arguments is not executed again
+    memo = metadata['memo']
+    if memo is not None and memo.is_pure(func_data, metadata['functions']):
+        key = (func_data['serial'], tuple(values[slot] for slot in func_data['param_slots']))
+        result = memo.lookup(func_name, key)
+        if result is UNSET:
+            result = run_function(call_scope, func_data, execute, metadata)
+            memo.store(key, result)
+        return result
+
+    return run_function(call_scope, func_data, execute, metadata)
+
+def run_function(call_scope, func_data, execute, metadata):
+    enter_function(call_scope, metadata) # Enter the function
+    try:
+        return execute(func_data, metadata) # Execute the function body
+    finally:
+        exit_function(metadata) # Exit the function, also if the body raised an error
+
+def enter_function(call_scope, metadata):
+    metadata['frames'].append(call_scope)
  
 def exit_function(metadata):
-    metadata['in_function'] = None
-
-def evaluate_gets_in_expression(expr, metadata):
-    pattern = re.compile(r'\[\s*\'get\'\s*,\s*\'([^\']+)\'\s*\]')
-    while True:
-        match = pattern.search(expr)
-        if not match:
-            break
-        var_name = match.group(1)
-        value = do_get([var_name], metadata)
-        # Replace the 'get' expression with its value in the expression
-        expr = expr[:match.start()] + str(value) + expr[match.end():]
-    return expr
+    metadata['frames'].pop()
 
+def create_metadata(tracer=None, memo=None):
+    # Everything a single evaluation of a program changes, so that several programs, or the same
+    # program several times, can be evaluated at once (e.g. from different threads)
+    return {
+        'frames': [], # The scopes of the running calls, the last one is the active call
+        'globals': GlobalScope(),
+        'functions': {},
+        'analyzed': {}, # {id of a function node: (node, layout and variables of the function)}
+        'tracer': tracer,
+        'memo': memo, # Memoizer of the pure functions, None unless --memoize is given
+        'native': False, # True if the functions are translated to Python code (pycompile backend)
+        'closures': False, # True if the bodies of the functions are compiled to closures (closure backend)
+        'sampled': False, # True while a Sampler reads the frames
+        # The operations check their arguments on every evaluation unless the program was validated
+        'ops': CHECKED_OPS,
+        'pushers': CHECKED_PUSHERS,
+    }
 
 def convert_value(val):
     try:
@@ -247,59 +723,123 @@ def convert_value(val):
         except (ValueError, SyntaxError):
             raise ValueError(f"'{val}' is neither a number nor a list.")
 
+# Compiled once at import instead of on every evaluation
+GET_PATTERN = re.compile(r'\[\s*\'get\'\s*,\s*\'([^\']+)\'\s*\]')
+OPERATOR_PATTERN = re.compile(r'([+\-*/]|and|or|xor)', re.IGNORECASE) # look for operators.
+
+# We do it this way to avoid using eval() and avoiding else if statements
+OPERATORS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.floordiv, # to avoid having floats, and thene error because of that
+    'and': operator.and_,
+    'or': operator.or_,
+    'xor': operator.xor,
+}
 
-def solve_expression(args, operation, metadata):
-    assert len(args) == 2, f"Expected two arguments, got {len(args)}"
-    left = do(convert_value(args[0]), metadata) # Convert the arguments to values (numbers or nested expressions)
-    right = do(convert_value(args[1]), metadata)
-
-    # We do it this way to avoid using eval() and avoiding else if statements
-    OPERATORS = {
-        '+': operator.add,
-        '-': operator.sub,
-        '*': operator.mul,
-        '/': operator.floordiv, # to avoid having floats, and thene error because of that
-        'and': operator.and_,
-        'or': operator.or_,
-        'xor': operator.xor,
-    }
-    op_func = OPERATORS.get(operation.lower())
-    # Check if the operator is supported
-    if op_func is None:
-        raise ValueError(f"Unsupported operator: {operation}")
-    return op_func(left, right)
-
-def evaluate_expression(expr, metadata):
-    expr = evaluate_gets_in_expression(expr, metadata)
-    
-    def find_bracket_ranges(expr): # Function to find nested [] if they are in the left side of the operator.
-        stack = []  
-        ranges = []
-        for i, char in enumerate(expr):
-            if char == '[':
-                stack.append(i) # We decided to use a stack inspired by pushdowns automatas, to check if im inside a nested []
-            elif char == ']':
-                start = stack.pop()
-                ranges.append((start, i))
-        return ranges
-
-    def is_inside_brackets(index, ranges):
-        for start, end in ranges:
-            if start < index < end:
-                return True
-        return False
-    
+class LruCache(OrderedDict):
+    # Caches that live as long as the process, e.g. a batch or serve worker that runs many programs,
+    # keep only the `size` most recently used entries instead of every program they have seen
+    def __init__(self, size):
+        super().__init__()
+        self.size = size
+
+    def lookup(self, key):
+        value = self.get(key)
+        if value is not None:
+            try:
+                self.move_to_end(key)
+            except KeyError: # Evicted by another thread in the meantime
+                pass
+        return value
+
+    def add(self, key, value):
+        self[key] = value
+        while len(self) > self.size:
+            try:
+                self.popitem(last=False) # Evict the least recently used entry
+            except KeyError:
+                break
+
+# Infix strings are parsed once into a small AST and reused on later evaluations
+# {source string: node}, where a node is one of:
+#   ('value', 5)                      an integer literal
+#   ('get', 'x')                      a variable, looked up when the node is evaluated
+#   ('expr', ['add', 1, 2])           a nested LGL expression, evaluated with do()
+#   ('operation', func, left, right)  an infix operator applied to two nodes
+#   ('empty',)                        no operator outside of brackets, evaluates to None
+INFIX_CACHE = LruCache(10000)
+
+def find_bracket_ranges(expr): # Function to find nested [] if they are in the left side of the operator.
+    stack = []  
+    ranges = []
+    for i, char in enumerate(expr):
+        if char == '[':
+            stack.append(i) # We decided to use a stack inspired by pushdowns automatas, to check if im inside a nested []
+        elif char == ']':
+            start = stack.pop()
+            ranges.append((start, i))
+    return ranges
+
+def is_inside_brackets(index, ranges):
+    for start, end in ranges:
+        if start < index < end:
+            return True
+    return False
+
+def parse_infix(expr):
+    node = INFIX_CACHE.lookup(expr)
+    if node is None:
+        node = parse_operation(expr)
+        INFIX_CACHE.add(expr, node)
+    return node
+
+def parse_operation(expr):
     bracket_ranges = find_bracket_ranges(expr) # Return the indixes of the [] to check if the operator is inside or if it is okey to do the funciton.
-    pattern = re.compile(r'([+\-*/]|and|or|xor)', re.IGNORECASE) # look for operators.
 
-    for match in pattern.finditer(expr): # Look for operators outside the []
+    for match in OPERATOR_PATTERN.finditer(expr): # Look for operators outside the []
         op = match.group(0) # Get the operator
         index = match.start() # Get the index of the operator
         if not is_inside_brackets(index, bracket_ranges): # Cheecks that the operator is outside the []
-            left = expr[:index].strip()
-            right = expr[index + len(op):].strip()
-            args = [left, right]
-            return solve_expression(args, op, metadata)
+            op_func = OPERATORS.get(op.lower())
+            # Check if the operator is supported
+            if op_func is None:
+                raise ValueError(f"Unsupported operator: {op}")
+            left = parse_operand(expr[:index].strip())
+            right = parse_operand(expr[index + len(op):].strip())
+            return ('operation', op_func, left, right)
+    return ('empty',)
+
+def parse_operand(val):
+    # A plain ['get', 'x'] stays a variable reference instead of being replaced by its current value
+    match = GET_PATTERN.fullmatch(val)
+    if match:
+        return ('get', match.group(1))
+
+    value = convert_value(val) # Convert the argument to a number or a nested expression
+    if isinstance(value, int):
+        return ('value', value)
+    if len(value) == 1 and isinstance(value[0], str): # A quoted infix string, e.g. "['['get', 'x'] * 20']"
+        return parse_infix(value[0])
+    return ('expr', value)
+
+def evaluate_infix(node, metadata):
+    kind = node[0]
+    if kind == 'value':
+        return node[1]
+    if kind == 'get':
+        return lookup_variable(node[1], metadata)
+    if kind == 'expr':
+        return do(node[1], metadata)
+    if kind == 'operation':
+        left = evaluate_infix(node[2], metadata)
+        right = evaluate_infix(node[3], metadata)
+        return node[1](left, right)
+    return None
+
+def evaluate_expression(expr, metadata):
+    return evaluate_infix(parse_infix(expr), metadata)
 
 
 ##############################################
@@ -307,66 +847,72 @@ def evaluate_expression(expr, metadata):
 ##############################################
 
 def do_sequence(args, metadata):
-    assert len(args) > 0
     result = None
     for expr in args:
         result = do(expr, metadata)
     return result
 
 def do_add(args, metadata):
-    assert len(args) == 2
     left = do(args[0], metadata)
     right = do(args[1], metadata)
     return left + right
 
 def do_substract(args, metadata):
-    assert len(args) == 2
     left = do(args[0], metadata)
     right = do(args[1], metadata)
     return left - right
 
 def do_multiplication(args, metadata):
-    assert len(args) == 2
     left = do(args[0], metadata)
     right = do(args[1], metadata)
     return left * right
 
 def do_division(args, metadata):
-    assert len(args) == 2
     left = do(args[0], metadata)
     right = do(args[1], metadata)
     assert right != 0, "Error: division by 0"
     return left // right
 
+# The right operand of or/and and the branch of if that is not taken are never evaluated
 def do_or(args, metadata):
-    assert len(args) == 2
-    left = do(args[0], metadata)
-    right = do(args[1], metadata)
-    return left or right
+    return do(args[0], metadata) or do(args[1], metadata)
 
 def do_and(args, metadata):
-    assert len(args) == 2
-    left = do(args[0], metadata)
-    right = do(args[1], metadata)
-    return left and right
+    return do(args[0], metadata) and do(args[1], metadata)
+
+def do_if(args, metadata):
+    return do(args[1] if do(args[0], metadata) else args[2], metadata)
 
 def do_xor(args, metadata):
-    assert len(args) == 2
     left = do(args[0], metadata)
     right = do(args[1], metadata)
     return left ^ right
 
 def do_absolute(args, metadata):
-    assert len(args) == 1
     val = do(args[0], metadata)
     return abs(val)
 
 def do_power(args, metadata):
-    assert len(args) == 2
     num = do(args[0], metadata)
     power = do(args[1], metadata)
     return num ** power
 
+# The arithmetic operations above also work on arrays, element by element (see array_values.py)
+def do_array(args, metadata):
+    return make_array(*[do(arg, metadata) for arg in args])
+
+def do_range(args, metadata):
+    return make_range(*[do(arg, metadata) for arg in args])
+
+def do_sum(args, metadata):
+    return array_sum(do(args[0], metadata))
+
+def do_min(args, metadata):
+    return array_min(do(args[0], metadata))
+
+def do_max(args, metadata):
+    return array_max(do(args[0], metadata))
+
 # RETRIEVE OPERATIONS DINAMICALLY AND STORE THEM IN A DICTIONARY
 # {operation_name: function}
 OPS = {
@@ -375,46 +921,1610 @@ OPS = {
     if name.startswith("do_")
 }
 
+##############################################
+################# VALIDATION #################
+##############################################
+
+# Number of arguments of every operation: (minimum, maximum or None for any number, description)
+ARGUMENTS = {
+    'set': (2, 2, 'name and value'),
+    'call': (1, None, 'function name and arguments'),
+    'get': (1, 1, 'name'),
+    'sequence': (1, None, 'steps'),
+    'add': (2, 2, None),
+    'substract': (2, 2, None),
+    'multiplication': (2, 2, None),
+    'division': (2, 2, None),
+    'or': (2, 2, None),
+    'and': (2, 2, None),
+    'if': (3, 3, 'condition, then and else'),
+    'xor': (2, 2, None),
+    'absolute': (1, 1, None),
+    'power': (2, 2, None),
+    'array': (0, None, None),
+    'range': (1, 3, '[start,] stop [, step]'),
+    'sum': (1, 1, None),
+    'min': (1, 1, None),
+    'max': (1, 1, None),
+}
+# Operations whose first argument is a name
+NAMES = {
+    'set': 'Variable name',
+    'get': 'Variable name',
+    'call': 'Function name',
+}
+
+class ProgramError(ValueError):
+    # Raised by prepare_program() with all the errors validate_program() found
+    def __init__(self, errors):
+        self.errors = errors # [(JSON path, message)]
+        super().__init__('; '.join(f'{path}: {message}' for path, message in errors))
+
+def argument_error(operation, args):
+    # The message of the error in the arguments of an operation, None if they are well-formed
+    minimum, maximum, description = ARGUMENTS[operation]
+    if len(args) < minimum or (maximum is not None and len(args) > maximum):
+        if minimum == maximum:
+            expected = f'exactly {minimum} argument{"s" if minimum != 1 else ""}'
+        elif maximum is None:
+            expected = f'at least {minimum} argument{"s" if minimum != 1 else ""}'
+        else:
+            expected = f'{minimum} to {maximum} arguments'
+        return f'Expected {expected}{": " + description if description else ""}, got {len(args)}'
+    if operation in NAMES and not isinstance(args[0], str):
+        return f"{NAMES[operation]} must be a string, got {type(args[0])}"
+    return None
+
+def check_arguments(operation, args):
+    message = argument_error(operation, args)
+    assert message is None, message
+
+def checked_operation(operation):
+    def checked(args, metadata):
+        check_arguments(operation, args)
+        return OPS[operation](args, metadata) # Looked up on every call, so --metrics also measures it
+    return checked
+
+CHECKED_OPS = {operation: checked_operation(operation) for operation in OPS}
+
+def validate_program(program):
+    # Checks the structure of the whole program once, before it runs: the operations and their arguments,
+    # the names, the function definitions and the number of arguments of every call of a function that is
+    # defined in the program. Returns all the errors as (JSON path, message), e.g. ('$[2][1]', 'Expected ...').
+    errors = []
+    definitions = {} # {function name: numbers of parameters of its definitions}
+    calls = [] # (JSON path, function name, number of arguments)
+    validate_node(program, '$', definitions, calls, errors)
+    for path, name, count in calls:
+        # A call of a function that is not defined is only an error if it is reached, e.g. it may be in a
+        # function that is never called, so it is left to the run
+        if name in definitions and count not in definitions[name]:
+            expected = ' or '.join(str(number) for number in sorted(definitions[name]))
+            errors.append((path, f"Function {name} expects {expected} arguments but got {count}"))
+    errors.sort(key=lambda error: [int(index) for index in re.findall(r'\d+', error[0])]) # In the order of the source
+    return errors
+
+def validate_node(expr, path, definitions, calls, errors):
+    if isinstance(expr, int):
+        return
+    if isinstance(expr, str):
+        try:
+            node = parse_infix(expr)
+        except (ValueError, SyntaxError) as error:
+            errors.append((path, f"Invalid infix expression {expr!r}: {error}"))
+            return
+        validate_infix(node, path, definitions, calls, errors)
+        return
+    if not isinstance(expr, list):
+        errors.append((path, f"Expected a number, an infix string or a list, got {type(expr).__name__}: {expr!r}"))
+        return
+    if not expr:
+        errors.append((path, "Empty expression"))
+        return
+    if len(expr) == 1 and isinstance(expr[0], str):
+        validate_node(expr[0], f'{path}[0]', definitions, calls, errors)
+        return
+
+    operation, args = expr[0], expr[1:]
+    if not isinstance(operation, str) or operation not in ARGUMENTS:
+        hint = ' (functions are defined with ["set", name, ["function", params, body]])' if operation == 'function' else ''
+        errors.append((f'{path}[0]', f"Unknown operation: {operation}{hint}"))
+        return
+    message = argument_error(operation, args)
+    if message is not None:
+        errors.append((path, message))
+        return
+
+    first = 1 # Index of the first argument that is an expression
+    if operation == 'get':
+        return
+    if operation == 'set':
+        first = 2
+        if isinstance(args[1], list) and args[1] and args[1][0] == 'function':
+            validate_function(args[0], args[1], f'{path}[2]', definitions, calls, errors)
+            return
+    if operation == 'call':
+        first = 2
+        calls.append((path, args[0], len(args) - 1))
+    for index in range(first, len(expr)):
+        validate_node(expr[index], f'{path}[{index}]', definitions, calls, errors)
+
+def validate_function(name, value, path, definitions, calls, errors):
+    if len(value) != 3:
+        errors.append((path, 'Expected a function definition: ["function", params, body]'))
+        return
+    params = [value[1]] if isinstance(value[1], str) else value[1]
+    if isinstance(params, list) and all(isinstance(param, str) for param in params):
+        definitions.setdefault(name, set()).add(len(params))
+    else:
+        errors.append((f'{path}[1]', f"Parameters must be a name or a list of names, got {value[1]!r}"))
+    validate_node(value[2], f'{path}[2]', definitions, calls, errors)
+
+def validate_infix(node, path, definitions, calls, errors):
+    # Expressions inside an infix string have no JSON path of their own, they are reported at the string
+    if node[0] == 'expr':
+        validate_node(node[1], path, definitions, calls, errors)
+    elif node[0] == 'operation':
+        validate_infix(node[2], path, definitions, calls, errors)
+        validate_infix(node[3], path, definitions, calls, errors)
+
+##############################################
+################# OPTIMIZER ##################
+##############################################
+
+# Operations that can be computed when the program is loaded if all their operands are numbers
+FOLDABLE = {
+    'add': operator.add,
+    'substract': operator.sub,
+    'multiplication': operator.mul,
+    'division': operator.floordiv,
+    'xor': operator.xor,
+    'absolute': abs,
+    'power': operator.pow,
+}
+# Operations that only evaluate their other operands depending on the first one: {operation: number of operands}
+BRANCHES = {
+    'or': 2,
+    'and': 2,
+    'if': 3,
+}
+MAX_FOLDED_BITS = 4096 # Larger powers are left to the run, they may never be evaluated
+
+def optimize(expr):
+    # Returns a copy of the program where operations on numbers are replaced by their result and
+    # the steps of a sequence that only compute a number are removed. Infix strings are kept as they are.
+    if not isinstance(expr, list) or not expr:
+        return expr
+    if len(expr) == 1 and isinstance(expr[0], str):
+        return expr
+
+    operation = expr[0]
+    if operation == 'set' and len(expr) == 3 and is_function_node(expr[2]):
+        function = expr[2]
+        return ['set', expr[1], [function[0], function[1], optimize(function[2]), *function[3:]]]
+
+    args = [optimize(arg) for arg in expr[1:]]
+    if operation == 'sequence' and args:
+        # Numbers have no effect unless they are the result, a ["get", name] is kept because it can fail
+        args = [arg for arg in args[:-1] if not isinstance(arg, int)] + args[-1:]
+        if len(args) == 1:
+            return args[0]
+    if isinstance(operation, str) and operation in FOLDABLE:
+        value = fold_constant(operation, args)
+        if value is not None:
+            return value
+    if isinstance(operation, str) and operation in BRANCHES:
+        value = select_branch(operation, args)
+        if value is not UNSET:
+            return value
+    return [operation, *args]
+
+def is_function_node(value):
+    return isinstance(value, list) and len(value) == 3 and value[0] == 'function'
+
+def fold_constant(operation, args):
+    # None if the operation has to be evaluated when the program runs, e.g. to raise its error there
+    if len(args) != (1 if operation == 'absolute' else 2) or not all(isinstance(arg, int) for arg in args):
+        return None
+    if operation == 'division' and args[1] == 0:
+        return None
+    if operation == 'power' and (args[1] < 0 or abs(args[0]).bit_length() * args[1] > MAX_FOLDED_BITS):
+        return None
+    value = FOLDABLE[operation](*args)
+    return value if isinstance(value, int) else None
+
+def select_branch(operation, args):
+    # The operand that gives the result if the first one is a number, UNSET if it is only known when the program runs
+    if len(args) != BRANCHES[operation] or not isinstance(args[0], int):
+        return UNSET
+    if operation == 'or':
+        return args[0] or args[1]
+    if operation == 'and':
+        return args[0] and args[1]
+    return args[1] if args[0] else args[2]
+
+##############################################
+############## CLOSURE COMPILER ##############
+##############################################
+
+# The closure backend walks the body of a function once and turns every node into a
+# Python closure that already holds its children, so evaluating a node no longer has to
+# re-check types, look up OPS or slice the argument list.
+# Each compiled node has the signature node(metadata) -> value.
+
+CLOSURE_CACHE = LruCache(1000) # {id of a function body: (body, closure tree)}
+
+def compile_expr(expr):
+    if isinstance(expr, int):
+        return lambda metadata: expr
+
+    if isinstance(expr, str):
+        return lambda metadata: evaluate_expression(expr, metadata)
+
+    if not isinstance(expr, list):
+        return compile_failure(AssertionError(f"Expected expr to be a list, got {type(expr)}: {expr}"))
+
+    if len(expr) == 1 and isinstance(expr[0], str):
+        source = expr[0]
+        return lambda metadata: evaluate_expression(source, metadata)
+
+    operation = expr[0]
+    if operation not in COMPILERS:
+        return compile_failure(ValueError(f"Unknown operation: {operation}"))
+    try:
+        check_arguments(operation, expr[1:]) # Once per node instead of on every evaluation
+        return COMPILERS[operation](expr[1:])
+    except AssertionError as error:
+        # Malformed nodes only fail when they are reached, like in the tree-walker
+        return compile_failure(error)
+
+def compile_failure(error):
+    def fail(metadata):
+        raise error
+    return fail
+
+def compile_set(args):
+    keyword, value = args
+
+    if isinstance(value, list) and value[0] == 'function':
+        return lambda metadata: define_function(keyword, value, metadata) # The body is compiled when it is called
+
+    value_node = compile_expr(value)
+    return lambda metadata: assign_variable(keyword, value_node(metadata), metadata)
+
+def compile_call(args):
+    call_args = (args[0], [compile_expr(arg) for arg in args[1:]])
+    return lambda metadata: call_compiled(call_args, metadata)
+
+@trace
+def call_compiled(args, metadata):
+    func_name, arg_nodes = args
+    return invoke_function(func_name, arg_nodes, run_node, execute_compiled, metadata)
+
+def run_node(node, metadata):
+    return node(metadata)
+
+def execute_compiled(func_data, metadata):
+    body = func_data['compiled']
+    if body is None: # First call of this function object
+        body = func_data['compiled'] = compile_body(func_data['body'])
+    return body(metadata)
+
+def compile_body(body):
+    # The body is compiled once per function node, so a nested function that is defined on every call of its
+    # parent is not compiled again for every new function object
+    cached = CLOSURE_CACHE.lookup(id(body))
+    if cached and cached[0] is body:
+        return cached[1]
+    compiled = compile_expr(body)
+    CLOSURE_CACHE.add(id(body), (body, compiled))
+    return compiled
+
+def compile_get(args):
+    keyword = args[0]
+    return lambda metadata: lookup_variable(keyword, metadata)
+
+def compile_sequence(args):
+    *steps, last = [compile_expr(expr) for expr in args]
+    def sequence(metadata):
+        for step in steps:
+            step(metadata)
+        return last(metadata)
+    return sequence
+
+def compile_binary(combine):
+    def compiler(args):
+        left = compile_expr(args[0])
+        right = compile_expr(args[1])
+        return lambda metadata: combine(left(metadata), right(metadata))
+    return compiler
+
+def compile_unary(combine):
+    def compiler(args):
+        val = compile_expr(args[0])
+        return lambda metadata: combine(val(metadata))
+    return compiler
+
+def compile_variadic(combine):
+    # Operations with any number of operands
+    def compiler(args):
+        nodes = [compile_expr(arg) for arg in args]
+        return lambda metadata: combine(*[node(metadata) for node in nodes])
+    return compiler
+
+def compile_or(args):
+    left = compile_expr(args[0])
+    right = compile_expr(args[1])
+    return lambda metadata: left(metadata) or right(metadata)
+
+def compile_and(args):
+    left = compile_expr(args[0])
+    right = compile_expr(args[1])
+    return lambda metadata: left(metadata) and right(metadata)
+
+def compile_if(args):
+    condition, then, otherwise = [compile_expr(arg) for arg in args]
+    return lambda metadata: then(metadata) if condition(metadata) else otherwise(metadata)
+
+def divide(left, right):
+    assert right != 0, "Error: division by 0"
+    return left // right
+
+# Same keys as OPS, the operands are evaluated like in the do_ functions
+COMPILERS = {
+    'set': compile_set,
+    'call': compile_call,
+    'get': compile_get,
+    'sequence': compile_sequence,
+    'add': compile_binary(operator.add),
+    'substract': compile_binary(operator.sub),
+    'multiplication': compile_binary(operator.mul),
+    'division': compile_binary(divide),
+    'or': compile_or,
+    'and': compile_and,
+    'if': compile_if,
+    'xor': compile_binary(operator.xor),
+    'absolute': compile_unary(abs),
+    'power': compile_binary(operator.pow),
+    'array': compile_variadic(make_array),
+    'range': compile_variadic(make_range),
+    'sum': compile_unary(array_sum),
+    'min': compile_unary(array_min),
+    'max': compile_unary(array_max),
+}
+
+def run_compiled(program, metadata):
+    # The program itself is only evaluated once, compiling it would take longer than walking it. It is run by
+    # the tree-walker, and the bodies of the functions are compiled when they are called for the first time.
+    metadata['closures'] = True
+    return do(program, metadata)
+
+##############################################
+############## STACK EVALUATOR ###############
+##############################################
+
+# Evaluates the program with an explicit work stack instead of Python recursion, so the depth of the
+# LGL calls is only limited by memory. The work stack holds the nodes that still have to be evaluated
+# (they are never tuples) and tasks, the values of the evaluated nodes are kept on a separate value stack:
+#   (APPLY, function, count)           replace the last `count` values by function(*values), `count` may be 0
+#   (DISCARD,)                         drop the last value (a step of a sequence that is not the last one)
+#   (ASSIGN, name)                     assign the last value to a variable
+#   (CALL, name, function, count, id)  call a function with the last `count` values as arguments
+#   (RETURN, pending)                  leave the frame of a call, `pending` are the (name, trace id, memo key)
+#                                      of the calls that end with it
+#   (BRANCH, then, else)               replace the last value by the node `then` if it is true or `else`
+#                                      otherwise, KEEP keeps the value as the result (or, and, if)
+# A call whose next task is the RETURN of the running call is a tail call: it replaces the frame of the
+# running call instead of pushing a new one, so tail recursion runs in constant space. Only a traced or
+# memoized tail call is added to `pending`, since its end still has to be recorded.
+APPLY, DISCARD, ASSIGN, CALL, RETURN, BRANCH = range(6)
+DISCARD_TASK = (DISCARD,)
+KEEP = object()
+
+def run_stack(program, metadata):
+    values = []
+    work = [program]
+    pop_task = work.pop
+    push_value = values.append
+    pop_value = values.pop
+    pushers = metadata['pushers']
+    try:
+        while work:
+            task = pop_task()
+            if type(task) is not tuple: # A node
+                pusher = pushers.get(task[0]) if type(task) is list and len(task) > 1 else None
+                if pusher is not None:
+                    pusher(task[1:], values, work, metadata)
+                elif isinstance(task, int):
+                    push_value(task)
+                else:
+                    push_node(task, values, work, metadata)
+                continue
+            kind = task[0]
+            if kind == APPLY:
+                if task[2] == 2:
+                    right = pop_value()
+                    values[-1] = task[1](values[-1], right)
+                elif task[2] == 1:
+                    values[-1] = task[1](values[-1])
+                else:
+                    count = task[2]
+                    operands = values[len(values) - count:]
+                    del values[len(values) - count:]
+                    push_value(task[1](*operands))
+            elif kind == DISCARD:
+                pop_value()
+            elif kind == ASSIGN:
+                values[-1] = assign_variable(task[1], values[-1], metadata)
+            elif kind == CALL:
+                count = task[3]
+                arguments = values[len(values) - count:]
+                del values[len(values) - count:]
+                start_call(task[1], task[2], arguments, task[4], values, work, metadata)
+            elif kind == BRANCH:
+                node = task[1] if values[-1] else task[2]
+                if node is not KEEP:
+                    pop_value()
+                    work.append(node)
+            else:
+                finish_call(task[1], values, metadata)
+    except BaseException:
+        unwind(work, metadata)
+        raise
+    return values.pop()
+
+def push_node(expr, values, work, metadata):
+    # Same checks as do(), the operations push their steps with the pushers in PUSHERS
+    if isinstance(expr, int):
+        values.append(expr)
+        return
+
+    if isinstance(expr, str):
+        values.append(evaluate_expression(expr, metadata))
+        return
+
+    assert isinstance(expr, list), f"Expected expr to be a list, got {type(expr)}: {expr}"
+
+    if len(expr) == 1 and isinstance(expr[0], str):
+        values.append(evaluate_expression(expr[0], metadata))
+        return
+
+    pusher = metadata['pushers'].get(expr[0])
+    if pusher is None:
+        raise ValueError(f"Unknown operation: {expr[0]}")
+    pusher(expr[1:], values, work, metadata)
+
+def push_set(args, values, work, metadata):
+    keyword, value = args
+
+    if isinstance(value, list) and value[0] == 'function':
+        values.append(define_function(keyword, value, metadata))
+        return
+
+    operands = simple_values((value,), metadata)
+    if operands is None:
+        work.append((ASSIGN, keyword))
+        work.append(value)
+    else:
+        values.append(assign_variable(keyword, operands[0], metadata))
+
+def push_call(args, values, work, metadata):
+    # The call is traced before its arguments are evaluated, like the @trace wrapper of do_call()
+    tracer = metadata['tracer']
+    call_id = tracer.start(args[0]) if tracer is not None else None
+    try:
+        func_name = args[0]
+        arguments = args[1:]
+
+        if func_name not in metadata['functions']:
+            raise NameError(f"Function {func_name} not found")
+        func_data = metadata['functions'][func_name]
+        params = func_data['params']
+        if len(params) != len(arguments):
+            raise TypeError(f"Function {func_name} expects {len(params)} arguments but got {len(arguments)}")
+        arg_values = simple_values(arguments, metadata)
+    except BaseException:
+        if call_id is not None:
+            tracer.stop(call_id, args[0])
+        raise
+
+    if arg_values is None:
+        work.append((CALL, func_name, func_data, len(arguments), call_id))
+        work.extend(reversed(arguments)) # The arguments are evaluated from left to right
+    else:
+        start_call(func_name, func_data, arg_values, call_id, values, work, metadata)
+
+def simple_values(args, metadata):
+    # Numbers and variables are evaluated right away instead of through the work stack,
+    # None if one of the nodes has to be evaluated on the stack
+    result = []
+    for arg in args:
+        if isinstance(arg, int):
+            result.append(arg)
+        elif type(arg) is list and len(arg) == 2 and arg[0] == 'get' and isinstance(arg[1], str):
+            result.append(lookup_variable(arg[1], metadata))
+        else:
+            return None
+    return result
+
+def start_call(func_name, func_data, arguments, call_id, values, work, metadata):
+    call_scope = Scope(func_data['layout'], func_data['env'], func_data)
+    scope_values = call_scope.values
+    for slot, value in zip(func_data['param_slots'], arguments):
+        scope_values[slot] = value
+
+    key = None
+    memo = metadata['memo']
+    if memo is not None and memo.is_pure(func_data, metadata['functions']):
+        key = (func_data['serial'], tuple(scope_values[slot] for slot in func_data['param_slots']))
+        result = memo.lookup(func_name, key)
+        if result is not UNSET:
+            values.append(result)
+            if call_id is not None:
+                metadata['tracer'].stop(call_id, func_name)
+            return
+
+    if work and type(work[-1]) is tuple and work[-1][0] == RETURN:
+        # Tail call: nothing is left to do in the running call, so its frame is replaced.
+        # The call still ends (and is traced and memoized) together with the call it replaces.
+        metadata['frames'][-1] = call_scope
+        if call_id is not None or key is not None:
+            work[-1][1].append((func_name, call_id, key))
+    else:
+        enter_function(call_scope, metadata)
+        work.append((RETURN, [(func_name, call_id, key)]))
+    work.append(func_data['body'])
+
+def finish_call(pending, values, metadata):
+    exit_function(metadata)
+    result = values[-1]
+    for func_name, call_id, key in reversed(pending):
+        if key is not None:
+            metadata['memo'].store(key, result)
+        if call_id is not None:
+            metadata['tracer'].stop(call_id, func_name)
+
+def unwind(work, metadata):
+    # When an error is raised, the calls that are running are left from the innermost one outwards,
+    # like the finally blocks of the recursive backends
+    tracer = metadata['tracer']
+    for task in reversed(work):
+        if type(task) is not tuple:
+            continue
+        if task[0] == CALL:
+            if task[4] is not None:
+                tracer.stop(task[4], task[1])
+        elif task[0] == RETURN:
+            exit_function(metadata)
+            for func_name, call_id, key in reversed(task[1]):
+                if call_id is not None:
+                    tracer.stop(call_id, func_name)
+
+def push_get(args, values, work, metadata):
+    values.append(lookup_variable(args[0], metadata))
+
+def push_sequence(args, values, work, metadata):
+    work.append(args[-1])
+    for expr in reversed(args[:-1]):
+        work.append(DISCARD_TASK)
+        work.append(expr)
+
+def push_operation(combine, count):
+    apply = (APPLY, combine, count)
+    def pusher(args, values, work, metadata):
+        operands = simple_values(args, metadata)
+        if operands is None:
+            work.append(apply)
+            work.extend(reversed(args))
+        else:
+            values.append(combine(*operands))
+    return pusher
+
+def push_variadic(combine):
+    def pusher(args, values, work, metadata):
+        work.append((APPLY, combine, len(args)))
+        work.extend(reversed(args))
+    return pusher
+
+def push_branch(choose):
+    # choose(args) returns the nodes for a true and for a false first operand. A branch that is pushed
+    # right before the RETURN of a call can still end with a tail call.
+    def pusher(args, values, work, metadata):
+        then, otherwise = choose(args)
+        condition = simple_values(args[:1], metadata)
+        if condition is None:
+            work.append((BRANCH, then, otherwise))
+            work.append(args[0])
+            return
+        node = then if condition[0] else otherwise
+        if node is KEEP:
+            values.append(condition[0])
+        else:
+            work.append(node)
+    return pusher
+
+# Same keys as OPS and COMPILERS
+PUSHERS = {
+    'set': push_set,
+    'call': push_call,
+    'get': push_get,
+    'sequence': push_sequence,
+    'add': push_operation(operator.add, 2),
+    'substract': push_operation(operator.sub, 2),
+    'multiplication': push_operation(operator.mul, 2),
+    'division': push_operation(divide, 2),
+    'or': push_branch(lambda args: (KEEP, args[1])),
+    'and': push_branch(lambda args: (args[1], KEEP)),
+    'if': push_branch(lambda args: (args[1], args[2])),
+    'xor': push_operation(operator.xor, 2),
+    'absolute': push_operation(abs, 1),
+    'power': push_operation(operator.pow, 2),
+    'array': push_variadic(make_array),
+    'range': push_variadic(make_range),
+    'sum': push_operation(array_sum, 1),
+    'min': push_operation(array_min, 1),
+    'max': push_operation(array_max, 1),
+}
+
+def checked_pusher(operation):
+    def checked(args, values, work, metadata):
+        check_arguments(operation, args)
+        PUSHERS[operation](args, values, work, metadata)
+    return checked
+
+CHECKED_PUSHERS = {operation: checked_pusher(operation) for operation in PUSHERS}
+
+##############################################
+############## PYTHON COMPILER ###############
+##############################################
+
+# Translates every function into Python source when it is defined, the source is compiled once per function node.
+# Parameters and local variables become Python locals, so a function is only translated if it never reads
+# a local variable before setting it (the read would fall back to an outer variable) and defines no nested
+# functions (they would need the scope of the call). Anything else is left to the tree-walker, which also
+# runs the program itself since it is only evaluated once.
+PYCODE_CACHE = LruCache(1000) # {id of a function node: (node, factory of the Python functions or None)}
+
+class Untranslatable(Exception):
+    # Raised by PythonGenerator for a body it cannot translate, python_factory() then leaves it to the tree-walker
+    pass
+
+class PythonGenerator:
+    def __init__(self, params, layout):
+        self.assigned = set(params) # Locals that are set at this point of the body
+        self.layout = layout
+        self.names = {}
+        self.lines = []
+        self.indent = 1
+        self.temps = itertools.count()
+        self.constants = {}
+
+    def local(self, name):
+        if name not in self.names:
+            self.names[name] = f'v_{name}' if name.isidentifier() else f'v{len(self.names)}'
+        return self.names[name]
+
+    def constant(self, value):
+        name = f'_k{len(self.constants)}'
+        self.constants[name] = value
+        return name
+
+    def temp(self):
+        return f'_t{next(self.temps)}'
+
+    def emit(self, line):
+        self.lines.append('    ' * self.indent + line)
+
+    def operands(self, nodes):
+        # Translates the nodes in evaluation order. If a later node needs statements (e.g. a call), the
+        # earlier values are stored in temporaries first, so they are not computed after those statements.
+        results = []
+        ends = [] # Position in self.lines after the statements of every result
+        for node in nodes:
+            start = len(self.lines)
+            value = self.expr(node)
+            if len(self.lines) > start:
+                for index in reversed(range(len(results))):
+                    if not self.is_stable(results[index]):
+                        name = self.temp()
+                        self.lines.insert(ends[index], '    ' * self.indent + f'{name} = {results[index]}')
+                        ends = [end + 1 if end >= ends[index] else end for end in ends]
+                        results[index] = name
+            results.append(value)
+            ends.append(len(self.lines))
+        return results
+
+    def is_stable(self, value):
+        # Literals and temporaries have the same value after any statement
+        return is_literal(value) or value.startswith('_t')
+
+    def expr(self, node):
+        if not isinstance(node, (int, str, list)):
+            raise Untranslatable(f"Unsupported value: {node!r}")
+        if isinstance(node, int):
+            return repr(node)
+        if isinstance(node, str):
+            return self.infix(node)
+        if len(node) == 1 and isinstance(node[0], str):
+            return self.infix(node[0])
+
+        operation, args = node[0], node[1:]
+        if operation == 'sequence' and args:
+            for step in args[:-1]:
+                value = self.expr(step)
+                if not self.is_stable(value) and value not in self.names.values():
+                    self.emit(value) # Evaluated for its errors, the value is not used
+            return self.expr(args[-1])
+        if operation == 'get' and len(args) == 1 and isinstance(args[0], str):
+            return self.read(args[0])
+        if operation == 'set' and len(args) == 2 and isinstance(args[0], str):
+            return self.assign(*args)
+        if operation == 'call' and args and isinstance(args[0], str):
+            return self.call(args[0], args[1:])
+        if operation in ('or', 'and') and len(args) == 2:
+            return self.lazy(operation, *args)
+        if operation == 'if' and len(args) == 3:
+            return self.conditional(*args)
+        if operation in PYTHON_OPERATIONS and len(args) == (1 if operation == 'absolute' else 2):
+            return PYTHON_OPERATIONS[operation].format(*self.operands(args))
+        if operation in PYTHON_FUNCTIONS and len(args) in PYTHON_FUNCTIONS[operation][1]:
+            return f'{PYTHON_FUNCTIONS[operation][0]}({", ".join(self.operands(args))})'
+        raise Untranslatable(f"Unsupported operation: {operation!r}")
+
+    def branch(self, node):
+        # Translates a node that is only evaluated under a condition, its statements are returned instead of
+        # emitted. Returns the statements, the value and the locals that are set at the end of the branch.
+        before = self.assigned
+        self.assigned = set(before)
+        self.indent += 1
+        start = len(self.lines)
+        value = self.expr(node)
+        lines = self.lines[start:]
+        del self.lines[start:]
+        self.indent -= 1
+        assigned, self.assigned = self.assigned, before
+        return lines, value, assigned
+
+    def lazy(self, operation, left, right):
+        left = self.expr(left)
+        lines, right, _ = self.branch(right)
+        if not lines:
+            return f'({left} {operation} {right})'
+        result = self.temp()
+        self.emit(f'{result} = {left}')
+        self.emit(f'if {"not " if operation == "or" else ""}{result}:')
+        self.lines.extend(lines)
+        self.emit(f'    {result} = {right}')
+        return result
+
+    def conditional(self, condition, then, otherwise):
+        condition = self.expr(condition)
+        then_lines, then, then_assigned = self.branch(then)
+        else_lines, otherwise, else_assigned = self.branch(otherwise)
+        self.assigned |= then_assigned & else_assigned
+        if not then_lines and not else_lines:
+            return f'({then} if {condition} else {otherwise})'
+        result = self.temp()
+        self.emit(f'if {condition}:')
+        self.lines.extend(then_lines)
+        self.emit(f'    {result} = {then}')
+        self.emit('else:')
+        self.lines.extend(else_lines)
+        self.emit(f'    {result} = {otherwise}')
+        return result
+
+    def read(self, name):
+        if name in self.assigned:
+            return self.local(name)
+        if name in self.layout:
+            raise Untranslatable(f"Variable {name} may be read before it is set")
+        return f'lookup_outer(func_data, {name!r}, metadata)'
+
+    def assign(self, name, value):
+        if isinstance(value, list) and value and value[0] == 'function':
+            raise Untranslatable("Nested functions need the scope of the call")
+        value = self.expr(value)
+        self.emit(f'{self.local(name)} = {value}')
+        self.assigned.add(name)
+        return self.local(name)
+
+    def call(self, name, args):
+        # Traced like the @trace wrapper of do_call(): the call starts before its arguments are evaluated
+        call, result = self.temp(), self.temp()
+        self.emit(f'{call} = begin_call({name!r}, {len(args)}, metadata)')
+        self.emit('try:')
+        self.indent += 1
+        values = self.operands(args)
+        self.emit(f'{result} = run_native({name!r}, {call}[0], ({"".join(value + ", " for value in values)}), metadata)')
+        self.indent -= 1
+        self.emit('finally:')
+        self.emit(f'    end_call({name!r}, {call}[1], metadata)')
+        return result
+
+    def infix(self, expr):
+        try:
+            node = parse_infix(expr)
+        except (ValueError, SyntaxError) as error:
+            raise Untranslatable(f"Unsupported infix expression: {expr}") from error
+        return self.infix_node(node)
+
+    def infix_node(self, node):
+        kind = node[0]
+        if kind == 'value':
+            return repr(node[1])
+        if kind == 'get':
+            return self.read(node[1])
+        if kind == 'expr':
+            return self.expr(node[1])
+        if kind == 'operation':
+            function = self.constant(node[1])
+            left = self.infix_node(node[2])
+            end = len(self.lines)
+            right = self.infix_node(node[3])
+            if len(self.lines) > end and not self.is_stable(left):
+                name = self.temp()
+                self.lines.insert(end, '    ' * self.indent + f'{name} = {left}')
+                left = name
+            return f'{function}({left}, {right})'
+        return 'None'
+
+    def source(self, params, result):
+        # The outer function binds the function object, which is needed to read outer variables
+        head = f'def lgl_function(metadata{"".join(", " + self.local(param) for param in params)}):'
+        lines = [head, *self.lines, f'    return {result}']
+        return 'def make(func_data):\n' + ''.join(f'    {line}\n' for line in lines) + '    return lgl_function'
+
+# Python expressions of the operations, both operands are always evaluated like in the do_ functions.
+# or, and and if are translated to Python conditions by PythonGenerator.
+PYTHON_OPERATIONS = {
+    'add': '({} + {})',
+    'substract': '({} - {})',
+    'multiplication': '({} * {})',
+    'division': 'divide({}, {})',
+    'xor': '({} ^ {})',
+    'absolute': 'abs({})',
+    'power': '({} ** {})',
+}
+
+# Operations that call a helper with their operands: {operation: (helper, numbers of operands)}
+PYTHON_FUNCTIONS = {
+    'array': ('make_array', range(sys.maxsize)),
+    'range': ('make_range', range(1, 4)),
+    'sum': ('array_sum', (1,)),
+    'min': ('array_min', (1,)),
+    'max': ('array_max', (1,)),
+}
+
+def is_literal(value):
+    return value.lstrip('-').isdigit() or value in ('True', 'False', 'None')
+
+def python_factory(value):
+    # Returns a function that creates the Python function of a function object, None if the body
+    # cannot be translated. The source is compiled once per function node.
+    cached = PYCODE_CACHE.lookup(id(value))
+    if cached and cached[0] is value:
+        return cached[1]
+
+    params = [value[1]] if isinstance(value[1], str) else value[1]
+    layout = {}
+    for param in params:
+        layout.setdefault(param, len(layout))
+    collect_variables(value[2], layout, set())
+    generator = PythonGenerator(params, layout)
+    try:
+        if len(set(params)) != len(params):
+            raise Untranslatable("Repeated parameters")
+        result = generator.expr(value[2])
+        namespace = dict(PYTHON_HELPERS, **generator.constants)
+        exec(compile(generator.source(params, result), '<lgl function>', 'exec'), namespace)
+        factory = namespace['make']
+    except (Untranslatable, RecursionError, SyntaxError):
+        factory = None
+    PYCODE_CACHE.add(id(value), (value, factory))
+    return factory
+
+def lookup_outer(func_data, keyword, metadata):
+    # Same order as lookup_variable() for a variable that is not local: the scopes the function was
+    # defined in, the variables of these scopes that were not known when the function was defined, then global
+    for scope, slot in func_data['addresses'].get(keyword, ()):
+        value = scope.values[slot]
+        if value is not UNSET:
+            return value
+    if func_data['env'] is not None:
+        value = func_data['env'].find(keyword)
+        if value is not UNSET:
+            return value
+    return metadata['globals'].get(keyword)
+
+def begin_call(func_name, count, metadata):
+    tracer = metadata['tracer']
+    call_id = tracer.start(func_name) if tracer is not None else None
+    func_data = metadata['functions'].get(func_name)
+    if func_data is None or len(func_data['params']) != count:
+        if call_id is not None:
+            tracer.stop(call_id, func_name)
+        if func_data is None:
+            raise NameError(f"Function {func_name} not found")
+        raise TypeError(f"Function {func_name} expects {len(func_data['params'])} arguments but got {count}")
+    return func_data, call_id
+
+def end_call(func_name, call_id, metadata):
+    if call_id is not None:
+        metadata['tracer'].stop(call_id, func_name)
+
+def run_native(func_name, func_data, arguments, metadata):
+    # A pure function that was already called with the same arguments is not executed again. The check is
+    # written out here, like in do_call(), so that a call does not need another Python frame for it.
+    key = None
+    memo = metadata['memo']
+    if memo is not None and memo.is_pure(func_data, metadata['functions']):
+        key = (func_data['serial'], arguments)
+        result = memo.lookup(func_name, key)
+        if result is not UNSET:
+            return result
+
+    native = func_data['native']
+    if native is None: # Not translated, run the body with the tree-walker in a scope of its own
+        call_scope = Scope(func_data['layout'], func_data['env'], func_data)
+        for slot, value in zip(func_data['param_slots'], arguments):
+            call_scope.values[slot] = value
+        enter_function(call_scope, metadata)
+        try:
+            result = do(func_data['body'], metadata)
+        finally:
+            exit_function(metadata)
+    elif not metadata['sampled']:
+        result = native(metadata, *arguments)
+    else:
+        # Without the frames, the samples of a recursive call would only show the outermost one
+        frames = metadata['frames']
+        frames.append(NativeFrame(func_data))
+        try:
+            result = native(metadata, *arguments)
+        finally:
+            frames.pop()
+
+    if key is not None:
+        memo.store(key, result)
+    return result
+
+class NativeFrame:
+    # Frame of a call of a Python function, which keeps its variables in locals. It only tells the sampler
+    # which function is running, nothing else reads the frames while a Python function runs.
+    __slots__ = ('function',)
+
+    def __init__(self, function):
+        self.function = function
+
+PYTHON_HELPERS = {
+    'divide': divide,
+    'lookup_outer': lookup_outer,
+    'begin_call': begin_call,
+    'end_call': end_call,
+    'run_native': run_native,
+    'make_array': make_array,
+    'make_range': make_range,
+    'array_sum': array_sum,
+    'array_min': array_min,
+    'array_max': array_max,
+}
+
+def run_pycompile(program, metadata):
+    metadata['native'] = True
+    return do(program, metadata)
+
+BACKENDS = {
+    'tree': do,
+    'closure': run_compiled,
+    'stack': run_stack,
+    'pycompile': run_pycompile,
+}
+
+##############################################
+################## METRICS ###################
+##############################################
+
+# Counts and times the evaluations of every operation, the depth of the variable lookups and the hits of
+# the caches. Nothing is measured unless install_metrics() is called: it replaces the functions in OPS and
+# the looked up helpers by measuring wrappers, so the interpreter has no extra work when metrics are off.
+# The operations are measured in the tree-walker, the lookups and caches in every backend.
+class Metrics:
+    def __init__(self):
+        self.counts = {}
+        self.total_ns = {} # Including the nested evaluations
+        self.self_ns = {} # Without the nested evaluations
+        self.nested_ns = [] # Time of the nested evaluations of every running evaluation
+        self.depths = {} # {'local', 'outer N' or 'global': number of lookups}
+        self.caches = {} # {cache name: [hits, misses]}
+
+    def timed(self, name, function):
+        counts, total_ns, self_ns, nested_ns = self.counts, self.total_ns, self.self_ns, self.nested_ns
+        counts[name] = total_ns[name] = self_ns[name] = 0
+        def measured(*args):
+            nested_ns.append(0)
+            start = time.perf_counter_ns()
+            try:
+                return function(*args)
+            finally:
+                elapsed = time.perf_counter_ns() - start
+                counts[name] += 1
+                total_ns[name] += elapsed
+                self_ns[name] += elapsed - nested_ns.pop()
+                if nested_ns:
+                    nested_ns[-1] += elapsed
+        return measured
+
+    def cached(self, name, function, is_cached):
+        counter = self.caches[name] = [0, 0]
+        def counted(*args):
+            counter[0 if is_cached(*args) else 1] += 1
+            return function(*args)
+        return counted
+
+    def counted_lookup(self, function):
+        depths = self.depths
+        def lookup(keyword, metadata):
+            depth = lookup_depth(keyword, metadata)
+            depths[depth] = depths.get(depth, 0) + 1
+            return function(keyword, metadata)
+        return lookup
+
+    def summary(self, memo=None):
+        caches = {name: {'hits': hits, 'misses': misses} for name, (hits, misses) in self.caches.items()}
+        if memo is not None:
+            caches['memo'] = {'hits': sum(memo.hits.values()), 'misses': sum(memo.misses.values())}
+        return {
+            'operations': {
+                name: {'count': count, 'total_ns': self.total_ns[name], 'self_ns': self.self_ns[name]}
+                for name, count in self.counts.items() if count
+            },
+            'lookup_depth': self.depths,
+            'caches': caches,
+        }
+
+def lookup_depth(keyword, metadata):
+    # Where lookup_variable() finds the variable: in the scope of the call, N scopes further out or globally
+    if metadata['frames']:
+        call_scope = metadata['frames'][-1]
+        for scope, slot in call_scope.function['addresses'].get(keyword, ()):
+            if (scope or call_scope).values[slot] is not UNSET:
+                if scope is None:
+                    return 'local'
+                depth, outer = 1, call_scope.parent
+                while outer is not scope:
+                    depth, outer = depth + 1, outer.parent
+                return f'outer {depth}'
+    return 'global'
+
+def install_metrics(metrics):
+    # Returns a function that puts the original functions back
+    module = globals()
+    originals = dict(OPS)
+    replaced = {}
+    for name, function in originals.items():
+        OPS[name] = metrics.timed(name, function)
+    wrappers = {
+        'evaluate_expression': metrics.timed('infix', evaluate_expression),
+        'lookup_variable': metrics.counted_lookup(lookup_variable),
+        'parse_infix': metrics.cached('infix', parse_infix, lambda expr: expr in INFIX_CACHE),
+        'analyze_function': metrics.cached(
+            'analysis', analyze_function, lambda value, metadata: id(value) in metadata['analyzed']
+        ),
+        'python_factory': metrics.cached('pycode', python_factory, lambda value: id(value) in PYCODE_CACHE),
+    }
+    for name, wrapper in wrappers.items():
+        replaced[name] = module[name]
+        module[name] = wrapper
+
+    def restore():
+        OPS.update(originals)
+        module.update(replaced)
+    return restore
+
+def format_metrics(summary):
+    lines = [f"{'Operation':<16}{'count':>10}{'total (ms)':>14}{'self (ms)':>14}{'avg (us)':>12}"]
+    operations = sorted(summary['operations'].items(), key=lambda item: -item[1]['self_ns'])
+    for name, stats in operations:
+        lines.append(
+            f"{name:<16}{stats['count']:>10}{stats['total_ns'] / 1e6:>14.3f}{stats['self_ns'] / 1e6:>14.3f}"
+            f"{stats['self_ns'] / stats['count'] / 1e3:>12.3f}"
+        )
+    lines.append('LOOKUP DEPTH | ' + ', '.join(f'{depth}: {count}' for depth, count in sorted(summary['lookup_depth'].items())))
+    lines.append('CACHES | ' + ', '.join(
+        f"{name}: {stats['hits']} hits, {stats['misses']} misses" for name, stats in summary['caches'].items()
+    ))
+    return '\n'.join(lines)
+
+##############################################
+############## PROGRAM LOADING ###############
+##############################################
+
+def prepare_program(source, optimize_program=True):
+    # Everything that only depends on the source: the parsed (and optimized) program, the analysis of its
+    # functions and the parsed infix strings. The result can be pickled, see ProgramCache.
+    program = json.loads(source)
+    errors = validate_program(program) # Before optimizing, so the JSON paths point into the source
+    if errors:
+        raise ProgramError(errors)
+    if optimize_program:
+        program = optimize(program)
+
+    functions = []
+    infix = {}
+    collect_prepared(program, functions, infix)
+    analyzed = {}
+    for value in functions:
+        try:
+            analyze_function(value, {'analyzed': analyzed})
+        except (TypeError, IndexError): # Malformed functions fail when they are defined, not when they are loaded
+            pass
+    return {'program': program, 'analyzed': list(analyzed.values()), 'infix': infix}
+
+def collect_prepared(expr, functions, infix):
+    # Finds the function nodes and the infix strings that can be evaluated
+    if isinstance(expr, str):
+        try:
+            infix[expr] = parse_infix(expr)
+        except (ValueError, SyntaxError): # Raised again when the string is evaluated
+            pass
+        return
+    if not isinstance(expr, list) or not expr:
+        return
+    if len(expr) == 1 and isinstance(expr[0], str):
+        collect_prepared(expr[0], functions, infix)
+        return
+
+    operation = expr[0]
+    if operation == 'get':
+        return
+    if operation == 'set' and len(expr) == 3:
+        value = expr[2]
+        if is_function_node(value):
+            functions.append(value)
+            collect_prepared(value[2], functions, infix)
+        else:
+            collect_prepared(value, functions, infix)
+        return
+    for item in expr[2:] if operation == 'call' else expr[1:]:
+        collect_prepared(item, functions, infix)
+
+def install_program(prepared, metadata):
+    # Prepared programs are validated, so the operations do not need to check their arguments again.
+    # The analysis is keyed by the function nodes, which are the same objects as in the loaded program.
+    metadata['ops'] = OPS
+    metadata['pushers'] = PUSHERS
+    for value, analysis in prepared['analyzed']:
+        metadata['analyzed'][id(value)] = (value, analysis)
+    for expr, node in prepared['infix'].items():
+        if expr not in INFIX_CACHE:
+            INFIX_CACHE.add(expr, node)
+    return prepared['program']
+
+##############################################
+################ BATCH MODE ##################
+##############################################
+
+# The modules that only the batch and serve modes need are imported by their functions, so that running a
+# single program does not wait for them
+
+def find_programs(pattern):
+    # All .gsc files of a directory, or the files matching a glob pattern
+    import glob
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.gsc')
+    return sorted(path for path in glob.glob(pattern) if os.path.isfile(path))
+
+def output_names(paths):
+    # The name of a program without its extension, numbered if several programs have the same name
+    names = []
+    seen = {}
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        seen[name] = seen.get(name, 0) + 1
+        names.append(name if seen[name] == 1 else f'{name}-{seen[name]}')
+    return names
+
+def run_batch_program(task):
+    # Runs in a worker process, every program gets its own metadata and therefore its own global scope
+    path, output, options = task
+    trace_file = output + '.trace' + options['trace_compression']
+    tracer = None
+    lines = []
+    try:
+        # Created here, so a trace file that cannot be written is the error of this program only
+        if options['trace']:
+            tracer = TraceSink(trace_file, options['trace_format'], **options['selection'])
+        metadata = create_metadata(tracer)
+        prepared = load_prepared(path, options)
+        result = BACKENDS[options['backend']](install_program(prepared, metadata), metadata)
+        lines.append('USER-DEFINED FUNCTIONS | ' + ', '.join(metadata['functions'].keys()))
+        status = f'RESULT | {result}'
+    except Exception as error: # The other programs of the batch keep running
+        status = f'ERROR | {type(error).__name__}: {error}'
+    finally:
+        if tracer:
+            tracer.close()
+    lines.append(status)
+    with open(output + '.out', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return status
+
+def load_prepared(path, options):
+    # The prepared program of a file, from the cache of --cache-dir if it is given
+    if options['cache_dir']:
+        from program_cache import ProgramCache
+        return ProgramCache(options['cache_dir']).load(
+            path, lambda source: prepare_program(source, options['optimize']), (options['optimize'],)
+        )
+    with open(path, 'rb') as source:
+        return prepare_program(source.read(), options['optimize'])
+
+def batch_main(argv):
+    from concurrent.futures import ProcessPoolExecutor
+    parser = argparse.ArgumentParser(
+        prog='lgl_interpreter.py batch',
+        description='Run many programs in a pool of worker processes.',
+        epilog='Example usage: python lgl_interpreter.py batch programs/ --output results --trace',
+        usage='lgl_interpreter.py batch programs [-h] [--output DIR] [--jobs N] [--backend {' + ','.join(BACKENDS) + '}] [--trace] [--trace-format {csv,binary}] [--trace-compression {' + ','.join(extension[1:] for extension in COMPRESSORS) + '}] [--trace-include GLOB[,GLOB]] [--trace-exclude GLOB[,GLOB]] [--trace-sample 1/N] [--trace-depth N] [--no-optimize] [--cache-dir DIR]'
+    )
+    parser.add_argument('programs', help='Directory with .gsc files or a glob pattern (e.g., "tests/*.gsc")')
+    parser.add_argument(
+        '--output', metavar='DIR', default='batch_output',
+        help='Directory for the output (NAME.out) and the trace (NAME.trace) of every program'
+    )
+    parser.add_argument(
+        '--jobs', type=int, default=os.cpu_count(),
+        help='Number of worker processes (default: number of CPUs)'
+    )
+    parser.add_argument('--backend', choices=BACKENDS.keys(), default='tree', help='Backend used for every program')
+    parser.add_argument('--trace', action='store_true', help='Write a trace for every program')
+    parser.add_argument('--trace-format', choices=TRACE_WRITERS.keys(), default='csv', help='Format of the traces')
+    parser.add_argument(
+        '--trace-compression', choices=[extension[1:] for extension in COMPRESSORS],
+        help='Compress the traces, which are then named NAME.trace.gz or NAME.trace.xz'
+    )
+    add_selection_arguments(parser)
+    parser.add_argument('--no-optimize', dest='optimize', action='store_false', help='Run the programs without optimizing them')
+    parser.add_argument('--cache-dir', metavar='DIR', help='Keep the prepared programs in DIR, see lgl_interpreter.py --cache-dir')
+
+    args = parser.parse_args(argv)
+    paths = find_programs(args.programs)
+    if not paths:
+        parser.error(f"No programs found for {args.programs}")
+    os.makedirs(args.output, exist_ok=True)
+
+    options = {
+        'backend': args.backend, 'trace': args.trace, 'trace_format': args.trace_format,
+        'trace_compression': '.' + args.trace_compression if args.trace_compression else '',
+        'selection': selection_options(args), 'optimize': args.optimize, 'cache_dir': args.cache_dir,
+    }
+    tasks = [(path, os.path.join(args.output, name), options) for path, name in zip(paths, output_names(paths))]
+
+    start = time.perf_counter()
+    # The workers are started once and keep the interpreter imported for all the programs they run
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        chunk_size = max(1, len(tasks) // (args.jobs * 4))
+        for path, status in zip(paths, executor.map(run_batch_program, tasks, chunksize=chunk_size)):
+            print(f'{path} | {status}')
+    elapsed = time.perf_counter() - start
+    print(f'BATCH | {len(paths)} programs in {elapsed:.3f} s ({len(paths) / elapsed:.1f} programs/sec)')
+
+##############################################
+################ SERVE MODE ##################
+##############################################
+
+# lgl_interpreter.py serve keeps the interpreter running and evaluates the programs sent by lgl_client.py over
+# a Unix socket, so a program does not pay for starting Python and importing the interpreter every time.
+# The protocol is described in lgl_client.py.
+
+def serve_request(request, options):
+    # Runs in a worker process, every request gets its own metadata and therefore its own global scope
+    import tempfile
+    try:
+        if not request.get('trace'):
+            return run_request(request, options, None)
+        # The trace is written to a temporary binary trace and sent back as a list of events
+        with tempfile.TemporaryDirectory() as directory:
+            trace_file = os.path.join(directory, 'request.trace')
+            response = run_request(request, options, trace_file)
+            response['trace'] = [
+                [call_id, timestamp, func_name, event, parent_id or 0]
+                for call_id, timestamp, func_name, event, parent_id in read_trace(trace_file)
+            ]
+            response['sample_rate'] = read_sample_rate(trace_file)
+            return response
+    except ProgramError as error: # Nothing was run
+        return {'error': f'{type(error).__name__}: {error}', 'invalid': error.errors}
+    except Exception as error:
+        return {'error': f'{type(error).__name__}: {error}'}
+
+def run_request(request, options, trace_file):
+    backend = request.get('backend', options['backend'])
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}")
+    prepared = prepare_request(request, options)
+    tracer = TraceSink(trace_file, 'binary', **trace_selection(request['trace'])) if trace_file else None
+    metadata = create_metadata(tracer)
+    start = time.perf_counter()
+    try:
+        result = BACKENDS[backend](install_program(prepared, metadata), metadata)
+        response = {'result': result if type(result) is int else str(result)}
+    except Exception as error: # The trace and the functions defined until the error are still sent back
+        response = {'error': f'{type(error).__name__}: {error}'}
+    finally:
+        if tracer:
+            tracer.close()
+    response['run_ms'] = (time.perf_counter() - start) * 1000
+    response['functions'] = list(metadata['functions'].keys())
+    return response
+
+def prepare_request(request, options):
+    # {"program": [...]} is sent with the request, {"path": "/path/code.gsc"} is read by the worker
+    if 'program' in request:
+        return prepare_program(json.dumps(request['program']), options['optimize'])
+    if 'path' in request:
+        return load_prepared(request['path'], options)
+    raise ValueError("A request needs a program or a path")
+
+def trace_selection(trace):
+    # "trace": true, or an object with the options of selective tracing in the syntax of the command line,
+    # e.g. {"include": "fib*,calc_?", "exclude": "*_helper", "sample": "1/10", "depth": 3}
+    trace = trace if isinstance(trace, dict) else {}
+    return {
+        'include': parse_patterns(trace.get('include', '')),
+        'exclude': parse_patterns(trace.get('exclude', '')),
+        'sample_rate': parse_sample_rate(str(trace.get('sample', '1'))),
+        'max_depth': trace.get('depth'),
+    }
+
+def start_worker():
+    # Ctrl+C stops the server, which then stops the workers
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def warm_up():
+    # Run by every worker before the first request, so the first requests do not wait for the workers to start
+    return os.getpid()
+
+def create_server(socket_path, options, workers):
+    # The classes of the server are defined here, so socketserver is only imported when the server starts
+    import socketserver
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+
+    class LglServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        # Every connection is handled by a thread, which waits while a worker process evaluates its requests
+        daemon_threads = True
+
+        def __init__(self, socket_path, options, workers):
+            super().__init__(socket_path, LglRequestHandler)
+            self.options = options
+            self.workers = workers
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=start_worker)
+            self.executor_lock = threading.Lock()
+            for future in [self.executor.submit(warm_up) for _ in range(workers)]:
+                future.result()
+
+        def evaluate(self, request):
+            executor = self.executor
+            try:
+                return executor.submit(serve_request, request, self.options).result()
+            except BrokenProcessPool:
+                # A worker was killed or crashed, the pool is replaced for the next requests
+                with self.executor_lock:
+                    if self.executor is executor:
+                        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=start_worker)
+                return {'error': 'BrokenProcessPool: the worker evaluating the program stopped'}
+
+        def server_close(self):
+            super().server_close()
+            self.executor.shutdown(cancel_futures=True)
+
+    class LglRequestHandler(socketserver.StreamRequestHandler):
+        # One JSON request per line, each answered with one JSON response per line, until the client disconnects
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("expected a JSON object")
+                except ValueError as error:
+                    response = {'error': f'Invalid request: {error}'}
+                else:
+                    response = self.server.evaluate(request)
+                try:
+                    self.wfile.write(json.dumps(response).encode() + b'\n')
+                except (BrokenPipeError, ConnectionResetError): # The client did not wait for the response
+                    return
+
+    return LglServer(socket_path, options, workers)
+
+def remove_stale_socket(socket_path):
+    # The socket file of a server that did not shut down is removed, the socket of a running server is kept
+    import socket
+    if not os.path.exists(socket_path):
+        return True
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(socket_path)
+            return False
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(socket_path)
+            return True
+
+def serve_main(argv):
+    import signal
+    from lgl_client import DEFAULT_SOCKET # The client shares the default, it is only imported to serve
+    parser = argparse.ArgumentParser(
+        prog='lgl_interpreter.py serve',
+        description='Evaluate the programs sent by lgl_client.py over a Unix socket in a pool of worker processes.',
+        epilog='Example usage: python lgl_interpreter.py serve --socket /tmp/lgl.sock --workers 4',
+        usage='lgl_interpreter.py serve [-h] [--socket PATH] [--workers N] [--backend {' + ','.join(BACKENDS) + '}] [--no-optimize] [--cache-dir DIR]'
+    )
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help=f'Path of the Unix socket (default: {DEFAULT_SOCKET})')
+    parser.add_argument(
+        '--workers', type=int, default=os.cpu_count(),
+        help='Number of worker processes, which evaluate that many programs at once (default: number of CPUs)'
+    )
+    parser.add_argument('--backend', choices=BACKENDS.keys(), default='tree', help='Backend of the requests that do not choose one')
+    parser.add_argument('--no-optimize', dest='optimize', action='store_false', help='Run the programs without optimizing them')
+    parser.add_argument('--cache-dir', metavar='DIR', help='Keep the programs sent as paths in DIR, see lgl_interpreter.py --cache-dir')
+
+    args = parser.parse_args(argv)
+    if not remove_stale_socket(args.socket):
+        parser.error(f"A server is already listening on {args.socket}")
+
+    options = {'backend': args.backend, 'optimize': args.optimize, 'cache_dir': args.cache_dir}
+    server = create_server(args.socket, options, args.workers)
+    os.chmod(args.socket, 0o600) # Only the user that started the server may send programs
+    # SIGTERM stops the server like Ctrl+C, so the socket file is removed as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f'SERVING | {args.socket} with {args.workers} workers', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
 ##############################################
 ############## MAIN FUNCTION #################
 ##############################################
 
 def main():
+    if sys.argv[1:2] == ['batch']: # lgl_interpreter.py batch <dir|glob> [options]
+        return batch_main(sys.argv[2:])
+    if sys.argv[1:2] == ['serve']: # lgl_interpreter.py serve [options]
+        return serve_main(sys.argv[2:])
+
     # Parse command-line arguments
     parser = argparse.ArgumentParser(
         description='Process a code file and an optional trace log file.',
         epilog='Example usage: python lgl_interpreter.py code.gsc --trace trace_file.log',
-        usage='lgl_interpreter.py code_file [-h] [--trace TRACE_FILE]'
+        usage='lgl_interpreter.py code_file [-h] [--trace TRACE_FILE] [--backend {tree,closure,stack,pycompile}] [--trace-format {csv,binary}] [--trace-buffer N] [--trace-include GLOB[,GLOB]] [--trace-exclude GLOB[,GLOB]] [--trace-sample 1/N] [--trace-depth N] [--memoize] [--memo-size N] [--no-optimize] [--dump-optimized OUTPUT_FILE] [--cache-dir DIR] [--cache-size MB] [--metrics] [--metrics-json OUTPUT_FILE] [--sample-ms N] [--sample-output OUTPUT_FILE]'
     )
     parser.add_argument('code_file', help='Path to the code file (e.g., code.gsc)')
     parser.add_argument(
-        '--trace', dest='trace_file', help='Path to the optional trace log file (e.g., trace_file.log)'
+        '--trace', dest='trace_file',
+        help='Path to the optional trace log file (e.g., trace_file.log), compressed if it ends with .gz or .xz'
+    )
+    parser.add_argument(
+        '--backend', choices=BACKENDS.keys(), default='tree',
+        help='Evaluate by walking the JSON tree (default), by compiling it to closures or Python code first or with an explicit work stack'
+    )
+    parser.add_argument(
+        '--trace-format', choices=TRACE_WRITERS.keys(), default='csv',
+        help='Write the trace as CSV (default) or in the compact binary format'
+    )
+    parser.add_argument(
+        '--trace-buffer', type=int, default=1000,
+        help='Number of trace events kept in memory before they are written to the trace file'
+    )
+    add_selection_arguments(parser)
+
+    parser.add_argument(
+        '--memoize', action='store_true',
+        help='Cache the results of pure functions and report the hits and misses at exit'
+    )
+    parser.add_argument(
+        '--memo-size', type=int, default=10000,
+        help='Number of results kept by --memoize before the least recently used ones are evicted'
+    )
+
+    parser.add_argument(
+        '--no-optimize', dest='optimize', action='store_false',
+        help='Run the program as it is, without folding the constant operations first'
+    )
+    parser.add_argument(
+        '--dump-optimized', metavar='OUTPUT_FILE',
+        help='Write the optimized program as JSON to OUTPUT_FILE'
+    )
+
+    parser.add_argument(
+        '--cache-dir', metavar='DIR',
+        help='Keep the prepared programs in DIR, so unchanged programs are not parsed and analyzed again'
+    )
+    parser.add_argument(
+        '--cache-size', metavar='MB', type=int, default=64,
+        help='Size of --cache-dir in megabytes before the least recently used programs are removed'
+    )
+
+    parser.add_argument(
+        '--metrics', action='store_true',
+        help='Count and time the evaluations of every operation and print a summary at exit (only with --backend tree)'
+    )
+    parser.add_argument(
+        '--metrics-json', metavar='OUTPUT_FILE',
+        help='Also write the metrics as JSON to OUTPUT_FILE (implies --metrics)'
+    )
+
+    parser.add_argument(
+        '--sample-ms', metavar='N', type=float,
+        help='Record the running LGL calls every N milliseconds and write them as collapsed stacks at exit'
+    )
+    parser.add_argument(
+        '--sample-output', metavar='OUTPUT_FILE', default='samples.collapsed',
+        help='File for the collapsed stacks of --sample-ms, shown with reporting.py OUTPUT_FILE --samples'
     )
 
     args = parser.parse_args()
-    
-    # Check if the trace file is provided
-    trace_file = args.trace_file
-    if trace_file:
-        with open(trace_file, mode='w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(['id', 'timestamp', 'function_name', 'event'])
-    
-    with open(args.code_file) as source:
-        program = json.load(source)
-    
+    if (args.metrics or args.metrics_json) and args.backend != 'tree':
+        # The other backends do not evaluate the operations through OPS, their table would stay empty
+        parser.error(f"--metrics only measures the tree-walker and cannot be used with --backend {args.backend}")
+
+    try:
+        if args.cache_dir:
+            from program_cache import ProgramCache # Only imported with --cache-dir, like the modules of batch mode
+            cache = ProgramCache(args.cache_dir, args.cache_size * 1024 * 1024)
+            prepared = cache.load(args.code_file, lambda source: prepare_program(source, args.optimize), (args.optimize,))
+        else:
+            with open(args.code_file, 'rb') as source:
+                prepared = prepare_program(source.read(), args.optimize)
+    except ProgramError as error: # Every error of the program at once, the program is not run
+        for path, message in error.errors:
+            print(f'INVALID PROGRAM | {path} | {message}')
+        sys.exit(1)
+
+    # Open the trace file once for the whole run if it is provided
+    tracer = TraceSink(
+        args.trace_file, args.trace_format, args.trace_buffer, **selection_options(args)
+    ) if args.trace_file else None
+
     # Initialize metadata
-    metadata = {
-        'in_function': None,
-        'globals': GLOBAL_SCOPE,
-        'functions': {},
-        'trace_file': trace_file
-    }
+    metadata = create_metadata(tracer, Memoizer(args.memo_size) if args.memoize else None)
+    program = install_program(prepared, metadata)
 
+    if args.dump_optimized:
+        with open(args.dump_optimized, 'w') as output:
+            json.dump(program, output, indent=4)
+
+    metrics = Metrics() if args.metrics or args.metrics_json else None
     print('BUILT-IN FUNCTIONS | ' + ', '.join(OPS.keys()))
-    result = do(program, metadata)
+    restore = install_metrics(metrics) if metrics else None
+    sampler = Sampler(metadata, args.sample_ms / 1000) if args.sample_ms else None
+    if sampler:
+        sampler.start()
+    try:
+        result = BACKENDS[args.backend](program, metadata)
+    finally:
+        if sampler:
+            sampler.stop()
+            sampler.write_collapsed(args.sample_output)
+        if restore:
+            restore()
+        if tracer: # Flush the buffered events, also when the program failed
+            tracer.close()
     print('USER-DEFINED FUNCTIONS | ' + ', '.join(metadata['functions'].keys()))
     print('RESULT |', result)
+    if metadata['memo'] is not None:
+        print('MEMOIZED FUNCTIONS | ' + metadata['memo'].report())
+    if metrics:
+        summary = metrics.summary(metadata['memo'])
+        print(format_metrics(summary))
+        if args.metrics_json:
+            with open(args.metrics_json, 'w') as output:
+                json.dump(summary, output, indent=4)
 
 if __name__ == "__main__":
     main()
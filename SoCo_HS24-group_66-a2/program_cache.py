@@ -0,0 +1,112 @@
+import contextlib, hashlib, os, pickle, tempfile
+
+try:
+    import fcntl
+except ImportError: # Windows, where runs that update the index at the same time may lose one of the updates
+    fcntl = None
+
+# Cache of prepared programs for lgl_interpreter.py --cache-dir.
+# An entry is the pickled result of preparing a program (parsing, optimizing and analyzing it) and is named
+# after the hash of the source and of the options that change the result, so a copy or an older version of a
+# program is found as well. The index maps the path of every program to its size, modification time and key,
+# so an unchanged program is found without reading it. The entries are evicted least recently used first.
+# Several runs may share the directory: the files are replaced atomically, and the index is read, changed
+# and written while holding a lock on LOCK_FILE, so runs that update it at the same time keep every update.
+
+INDEX_FILE = 'index.pickle'
+LOCK_FILE = 'index.lock'
+ENTRY_SUFFIX = '.pickle'
+CACHE_VERSION = 2 # Changed whenever the prepared programs change, so older entries are not used
+
+class ProgramCache:
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def load(self, code_file, prepare, options=()):
+        # Returns prepare(source) for the program, from the cache if possible
+        stat = os.stat(code_file)
+        path = os.path.abspath(code_file)
+        index = self.read_index()
+        known = index.get(path)
+
+        if known and known[:2] == (stat.st_size, stat.st_mtime_ns) and known[3] == options:
+            prepared = self.read_entry(known[2])
+            if prepared is not None:
+                return prepared
+
+        with open(code_file, 'rb') as f:
+            source = f.read()
+        key = hashlib.sha256(repr((CACHE_VERSION, options)).encode() + source).hexdigest()
+        prepared = self.read_entry(key)
+        missing = prepared is None
+        if missing:
+            prepared = prepare(source) # Without the lock, so other runs are not held up
+        with self.locked():
+            evicted = self.write_entry(key, prepared) if missing else set()
+            # Read again, other runs may have changed the index since it was read above
+            index = self.read_index()
+            index[path] = (stat.st_size, stat.st_mtime_ns, key, options)
+            self.write_index({known: record for known, record in index.items() if record[2] not in evicted})
+        return prepared
+
+    @contextlib.contextmanager
+    def locked(self):
+        with open(os.path.join(self.directory, LOCK_FILE), 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX) # Released when the file is closed
+            yield
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def read_entry(self, key):
+        try:
+            with open(self.entry_path(key), 'rb') as f:
+                prepared = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            return None # Missing, evicted or written by an incompatible version
+        os.utime(self.entry_path(key)) # The modification time of an entry is the time it was last used
+        return prepared
+
+    def write_entry(self, key, prepared):
+        # Returns the keys of the entries that were evicted to make room
+        self.write_file(self.entry_path(key), pickle.dumps(prepared, pickle.HIGHEST_PROTOCOL))
+        return self.evict()
+
+    def evict(self):
+        evicted = set()
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(ENTRY_SUFFIX) and name != INDEX_FILE:
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime_ns, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries): # Least recently used first
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError: # Removed by hand, or by a run on a system without fcntl
+                pass
+            evicted.add(name[:-len(ENTRY_SUFFIX)])
+            total -= size
+        return evicted
+
+    def read_index(self):
+        try:
+            with open(os.path.join(self.directory, INDEX_FILE), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return {}
+
+    def write_index(self, index):
+        self.write_file(os.path.join(self.directory, INDEX_FILE), pickle.dumps(index, pickle.HIGHEST_PROTOCOL))
+
+    def write_file(self, path, data):
+        # Written to a temporary file first, so other runs never read a half-written file
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
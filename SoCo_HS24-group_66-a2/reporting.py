@@ -1,80 +1,330 @@
-import csv, sys
-from datetime import datetime
+import argparse, math
+from concurrent.futures import ProcessPoolExecutor
 from prettytable import PrettyTable
-from collections import defaultdict
-
-def summary_stats(trace_file):
-    # Create a dictionary to store call logs for each function
-    # The dictionary will have function names as keys and a dictionary of call logs as values
-    # Each call log will have call ID as key and a dictionary of start and end times as values
-    # Example: {"foo": {
-    #               "b59bb6": {
-    #                       "start_time": "2021-09-01 12:00:00.000", 
-    #                       "end_time": "2021-09-01 12:00:01.000"
-    #                       }
-    #               },
-    #               "93f243": {
-    #                       "start_time": "2021-09-01 12:00:00.000", 
-    #                       "end_time": "2021-09-01 12:00:01.000"
-    #                       }
-    #               }
-    #          }
-    summary_calls = defaultdict(dict)
-
-    with open(trace_file, newline="") as f:
-        reader = csv.reader(f)
-        next(reader) # Skip the header row
-        for row in reader:
-            call_id, timestamp, func_name, event_type = row
-
-            # Handle "start" events by storing start time for each call_id
-            if event_type == "start":
-                summary_calls[func_name][call_id] = {"start_time": timestamp, "end_time": None}
-
-            # Handle "stop" events by updating end time for each call_id
-            elif event_type == "stop":
-                if call_id not in summary_calls[func_name]:
+from trace_format import read_trace, read_sample_rate, trace_shards
+
+# Durations are counted in HDR-style log-linear buckets: exact below 2^PRECISION_BITS ns,
+# then 2^(PRECISION_BITS - 1) buckets per power of two, so a percentile is off by at most ~3%
+# while a function never needs more than a few hundred buckets
+PRECISION_BITS = 6
+SUB_BUCKETS = 1 << (PRECISION_BITS - 1)
+PERCENTILES = (0.5, 0.9, 0.99)
+HISTOGRAM_LEVELS = " .:-=+*#%@"
+
+def bucket_index(duration):
+    shift = duration.bit_length() - PRECISION_BITS
+    if shift <= 0:
+        return duration
+    return (1 << PRECISION_BITS) + (shift - 1) * SUB_BUCKETS + (duration >> shift) - SUB_BUCKETS
+
+def bucket_bounds(index):
+    if index < (1 << PRECISION_BITS):
+        return index, index
+    shift, offset = divmod(index - (1 << PRECISION_BITS), SUB_BUCKETS)
+    low = (SUB_BUCKETS + offset) << (shift + 1)
+    return low, low + (1 << (shift + 1)) - 1
+
+class CallStats:
+    # Running totals of the completed calls of one function, in integer nanoseconds
+    __slots__ = ('num_calls', 'total', 'minimum', 'maximum', 'sum_of_squares', 'buckets')
+
+    def __init__(self):
+        self.num_calls = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = None
+        self.sum_of_squares = 0
+        self.buckets = {} # {bucket index: number of calls}
+
+    def add(self, duration):
+        self.num_calls += 1
+        self.total += duration
+        self.sum_of_squares += duration * duration
+        if self.minimum is None or duration < self.minimum:
+            self.minimum = duration
+        if self.maximum is None or duration > self.maximum:
+            self.maximum = duration
+        index = bucket_index(duration)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other):
+        # Two CallStats of the same function can be combined without losing anything
+        if other.num_calls == 0:
+            return
+        self.num_calls += other.num_calls
+        self.total += other.total
+        self.sum_of_squares += other.sum_of_squares
+        if self.minimum is None or other.minimum < self.minimum:
+            self.minimum = other.minimum
+        if self.maximum is None or other.maximum > self.maximum:
+            self.maximum = other.maximum
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def percentile(self, fraction):
+        rank = max(1, math.ceil(fraction * self.num_calls))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                low, high = bucket_bounds(index)
+                # The middle of the bucket, but never outside of the values that were seen
+                return min(max((low + high) // 2, self.minimum), self.maximum)
+        return self.maximum
+
+    def octaves(self):
+        # Number of calls per power of two of the duration, used for the ASCII histogram
+        counts = {}
+        for index, count in self.buckets.items():
+            octave = bucket_bounds(index)[0].bit_length()
+            counts[octave] = counts.get(octave, 0) + count
+        return counts
+
+def summary_stats(trace_file, jobs=1):
+    # The trace is aggregated in a single pass, so memory is bounded by the maximum call depth
+    # instead of the length of the trace. A compressed trace is decompressed while it is read.
+    if jobs > 1:
+        return parallel_summary_stats(trace_file, jobs)
+    summary, open_calls = aggregate_events(read_trace(trace_file))
+    return summary
+
+def aggregate_events(events, unmatched_stops=None):
+    # Only the calls that have started but not stopped yet are kept:
+    # Example: {("b59bb6", "foo"): 1630497600000000000}
+    open_calls = {}
+    # A completed call is folded into the totals of its function as soon as its stop event arrives
+    # Example: {"foo": CallStats(num_calls=2, total=..., minimum=..., maximum=..., sum_of_squares=...)}
+    # Timestamps are in nanoseconds, read_trace() detects whether the file is CSV or binary
+    summary = {}
+
+    for call_id, timestamp, func_name, event_type, parent_id in events:
+        # Handle "start" events by storing start time for each call_id
+        if event_type == "start":
+            open_calls[(call_id, func_name)] = timestamp
+            if func_name not in summary:
+                summary[func_name] = CallStats()
+
+        # Handle "stop" events by folding the duration of the call into the totals
+        elif event_type == "stop":
+            start_time = open_calls.pop((call_id, func_name), None)
+            if start_time is not None:
+                summary[func_name].add(timestamp - start_time)
+            elif unmatched_stops is not None: # The start is in an earlier shard
+                unmatched_stops.append(((call_id, func_name), timestamp))
+            else:
+                raise ValueError(f"Start event not found for call ID {call_id} of function {func_name}")
+
+    return summary, open_calls
+
+def summarize_shard(shard):
+    # Runs in a worker process: the partial totals of one shard, plus the starts and stops
+    # of the calls that cross the borders of the shard
+    trace_file, start, end, names = shard
+    unmatched_stops = []
+    summary, open_calls = aggregate_events(read_trace(trace_file, start, end, names), unmatched_stops)
+    return summary, open_calls, unmatched_stops
+
+def parallel_summary_stats(trace_file, jobs):
+    shards = [(trace_file, *shard) for shard in trace_shards(trace_file, jobs)]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        partials = executor.map(summarize_shard, shards)
+
+        # The shards are stitched back together in file order, so every stop that was not matched
+        # in its own shard finds its start among the calls still open in the earlier shards
+        summary = {}
+        open_calls = {}
+        for shard_summary, shard_open_calls, unmatched_stops in partials:
+            for func_name, calls in shard_summary.items():
+                summary.setdefault(func_name, CallStats()).merge(calls)
+            for (call_id, func_name), timestamp in unmatched_stops:
+                start_time = open_calls.pop((call_id, func_name), None)
+                if start_time is None:
                     raise ValueError(f"Start event not found for call ID {call_id} of function {func_name}")
-                summary_calls[func_name][call_id]["end_time"] = timestamp
+                summary[func_name].add(timestamp - start_time)
+            open_calls.update(shard_open_calls)
 
-    return summary_calls
+    return summary
 
-def calculate_stats(calls):
-    stats = []
-    for func_name, logs in calls.items():
-        total_time = 0
-        num_calls = 0
-
-        for log in logs.values():  # Iterate over each call log entry
-            if log["end_time"] is not None:
-                datetime_format = "%Y-%m-%d %H:%M:%S.%f"
-                start_time = datetime.strptime(log["start_time"], datetime_format)
-                end_time = datetime.strptime(log["end_time"], datetime_format)
-                
-                # Calculate time difference in milliseconds
-                time_diff_ms = (end_time - start_time).total_seconds() * 1000
-                total_time += time_diff_ms
-                num_calls += 1
+def profile_stats(trace_file):
+    # Rebuilds the call tree from the parent call IDs and splits the time of every call path
+    # into inclusive time (with the calls it made) and self time (without them)
+    # Example: {("outer", "inner"): [num_calls, inclusive_ns, self_ns]}
+    paths = {}
+    # The running calls: {call_id: [call path, start time, time spent in child calls, caller's call_id]}
+    open_calls = {}
+    stack = [] # Call IDs in start order, used to find the caller in traces without parent IDs
+
+    for call_id, timestamp, func_name, event_type, parent_id in read_trace(trace_file):
+        if event_type == "start":
+            if parent_id is None and stack:
+                parent_id = stack[-1]
+            parent = open_calls.get(parent_id)
+            path = parent[0] + (func_name,) if parent else (func_name,)
+            open_calls[call_id] = [path, timestamp, 0, parent_id]
+            stack.append(call_id)
+            if path not in paths:
+                paths[path] = [0, 0, 0]
 
+        elif event_type == "stop":
+            if call_id not in open_calls:
+                raise ValueError(f"Start event not found for call ID {call_id} of function {func_name}")
+            path, start_time, child_time, caller_id = open_calls.pop(call_id)
+            stack.remove(call_id)
+            inclusive = timestamp - start_time
+            totals = paths[path]
+            totals[0] += 1
+            totals[1] += inclusive
+            totals[2] += inclusive - child_time
+            # The caller is still running, its self time does not include this call
+            if caller_id in open_calls:
+                open_calls[caller_id][2] += inclusive
+
+    return paths
+
+def display_profile(paths, scale=1):
+    # A sampled trace (scale > 1) recorded one in `scale` calls, so its numbers of calls and times are scaled up
+    table = PrettyTable(["Call Path", "Num. of calls", "Inclusive Time (ms)", "Self Time (ms)"])
+    table.align["Call Path"] = "l"
+    for path, (num_calls, inclusive, self_time) in paths.items():
         if num_calls > 0:
-            avrg_time = total_time / num_calls  # Average time in milliseconds
-            stats.append((func_name, num_calls, f'{total_time:.3f}', f'{avrg_time:.3f}'))
+            table.add_row([
+                " > ".join(path), num_calls * scale,
+                f'{inclusive * scale / 1_000_000:.3f}', f'{self_time * scale / 1_000_000:.3f}'
+            ])
+    print(table)
+
+def write_collapsed(paths, output_file, scale=1):
+    # One line per call path with its self time in nanoseconds, the format read by flame graph tools
+    # Example: outer;inner;deepHelper 81000
+    with open(output_file, "w") as f:
+        for path, (num_calls, inclusive, self_time) in paths.items():
+            if num_calls > 0:
+                f.write(f'{";".join(path)} {self_time * scale}\n')
+
+def sample_stats(collapsed_file):
+    # Reads collapsed stacks with sample counts (lgl_interpreter.py --sample-ms) into the same
+    # structure as profile_stats(), with numbers of samples instead of times
+    # Example: {("outer", "inner"): [0, inclusive_samples, self_samples]}
+    paths = {}
+    with open(collapsed_file) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            stack, count = line.rsplit(" ", 1)
+            path = tuple(stack.split(";"))
+            count = int(count)
+            for depth in range(1, len(path) + 1):
+                totals = paths.setdefault(path[:depth], [0, 0, 0])
+                totals[1] += count
+            paths[path][2] += count
+    return paths
+
+def display_samples(paths):
+    total = sum(self_samples for _, _, self_samples in paths.values())
+    table = PrettyTable(["Call Path", "Inclusive Samples", "Inclusive (%)", "Self Samples", "Self (%)"])
+    table.align["Call Path"] = "l"
+    for path, (_, inclusive, self_samples) in sorted(paths.items()):
+        table.add_row([
+            " > ".join(path), inclusive, f'{inclusive * 100 / total:.1f}', self_samples, f'{self_samples * 100 / total:.1f}'
+        ])
+    print(table)
+
+def calculate_stats(summary, histogram=False, scale=1):
+    # A sampled trace (scale > 1) recorded one in `scale` calls: the number of calls and the total time are
+    # scaled up, the average, the percentiles and the other statistics of the recorded calls stay the same
+    stats = []
+    if histogram:
+        # Every histogram uses the same range of octaves so that the rows can be compared
+        octaves = [calls.octaves() for calls in summary.values() if calls.num_calls > 0]
+        lowest = min((min(counts) for counts in octaves), default=0)
+        highest = max((max(counts) for counts in octaves), default=0)
+
+    for func_name, calls in summary.items():
+        if calls.num_calls > 0:
+            n = calls.num_calls
+            # Times are converted from nanoseconds to milliseconds
+            total_time = calls.total / 1_000_000
+            avrg_time = total_time / n  # Average time in milliseconds
+            # Population standard deviation, computed exactly on the integer sums
+            std_dev = math.sqrt(n * calls.sum_of_squares - calls.total ** 2) / n / 1_000_000
+            percentiles = [f'{calls.percentile(fraction) / 1_000_000:.3f}' for fraction in PERCENTILES]
+            stat = (
+                func_name, n * scale, f'{total_time * scale:.3f}', f'{avrg_time:.3f}', f'{calls.minimum / 1_000_000:.3f}',
+                *percentiles, f'{calls.maximum / 1_000_000:.3f}', f'{std_dev:.3f}'
+            )
+            if histogram:
+                stat += (ascii_histogram(calls.octaves(), lowest, highest),)
+            stats.append(stat)
 
     return stats
 
-def display_stats(stats):
-    table = PrettyTable(["Function Name", "Num. of calls", "Total Time (ms)", "Average Time (ms)"])
+def ascii_histogram(counts, lowest, highest):
+    # One character per power of two of the duration, darker characters mean more calls
+    peak = max(counts.values())
+    levels = len(HISTOGRAM_LEVELS) - 1
+    return ''.join(
+        HISTOGRAM_LEVELS[math.ceil(counts.get(octave, 0) * levels / peak)]
+        for octave in range(lowest, highest + 1)
+    )
+
+def display_stats(stats, histogram=False):
+    columns = [
+        "Function Name", "Num. of calls", "Total Time (ms)", "Average Time (ms)", "Min Time (ms)",
+        "p50 (ms)", "p90 (ms)", "p99 (ms)", "Max Time (ms)", "Std Dev (ms)"
+    ]
+    if histogram:
+        columns.append("Histogram (log2 ns)")
+    table = PrettyTable(columns)
+    if histogram:
+        table.align["Histogram (log2 ns)"] = "l"
     for stat in stats:
         table.add_row(stat)
     print(table)
 
 def main():
-    assert len(sys.argv) == 2, "Usage: python reporting.py <trace_file>"
+    parser = argparse.ArgumentParser(
+        description='Report the performance of every function in a trace file.',
+        epilog='Example usage: python reporting.py trace_file.log --histogram'
+    )
+    parser.add_argument('trace_file', help='Path to the CSV or binary trace file (also compressed as .gz or .xz), or to the collapsed stacks of --samples')
+    parser.add_argument(
+        '--histogram', action='store_true',
+        help='Add an ASCII histogram of the call durations to the table'
+    )
+    parser.add_argument(
+        '--jobs', type=int, default=1,
+        help='Number of processes that parse shards of the trace in parallel (a compressed trace is read by one process)'
+    )
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='Report self and inclusive time per call path instead of per function'
+    )
+    parser.add_argument(
+        '--collapsed', metavar='OUTPUT_FILE',
+        help='Write the call paths as collapsed stacks for flame graph tools (implies --profile)'
+    )
+    parser.add_argument(
+        '--samples', action='store_true',
+        help='Report the collapsed stacks written by lgl_interpreter.py --sample-ms instead of a trace'
+    )
+    args = parser.parse_args()
+
     try:
-        trace_file = sys.argv[1]
-        calls = summary_stats(trace_file)
-        stats = calculate_stats(calls)
-        display_stats(stats)
+        scale = 1 if args.samples else read_sample_rate(args.trace_file)
+        if scale > 1:
+            print(f'SAMPLED TRACE | 1 in {scale} calls recorded, the numbers of calls and the total times are estimates')
+        if args.samples:
+            display_samples(sample_stats(args.trace_file))
+        elif args.profile or args.collapsed:
+            # The call tree is rebuilt in a single process, --jobs does not apply
+            paths = profile_stats(args.trace_file)
+            display_profile(paths, scale)
+            if args.collapsed:
+                write_collapsed(paths, args.collapsed, scale)
+        else:
+            summary = summary_stats(args.trace_file, args.jobs)
+            stats = calculate_stats(summary, args.histogram, scale)
+            display_stats(stats, args.histogram)
     
     except Exception as e:
         raise e
@@ -0,0 +1,80 @@
+import operator
+import pytest
+import array_values
+from array_values import LIMIT, make_array, make_range, array_sum, array_min, array_max
+
+# Tests of array_values.py, run with: python -m pytest
+# Every test runs with NumPy (if it is installed) and with the array module, the results have to be the same.
+
+@pytest.fixture(params=['numpy', 'array'], autouse=True)
+def storage(request, monkeypatch):
+    if request.param == 'numpy':
+        if array_values.load_numpy() is None:
+            pytest.skip('NumPy is not installed')
+    else:
+        monkeypatch.setattr(array_values, 'numpy', None)
+        monkeypatch.setattr(array_values, 'numpy_loaded', True)
+    return request.param
+
+# --------------------------------------------------------------------
+# OPERATIONS
+# --------------------------------------------------------------------
+def test_elementwise():
+    values = make_range(1, 6)
+    assert list(values + 1) == [2, 3, 4, 5, 6]
+    assert list(10 - values) == [9, 8, 7, 6, 5]
+    assert list(values * values) == [1, 4, 9, 16, 25]
+    assert list(values // 2) == [0, 1, 1, 2, 2]
+    assert list(2 ** values) == [2, 4, 8, 16, 32]
+    assert list(abs(make_array(-3, 4))) == [3, 4]
+    assert (array_sum(values), array_min(values), array_max(values)) == (15, 1, 5)
+
+def test_errors():
+    with pytest.raises(AssertionError, match='division by 0'):
+        make_range(3) // make_array(1, 0, 2)
+    with pytest.raises(AssertionError, match='different lengths'):
+        make_range(3) + make_range(4)
+    with pytest.raises(AssertionError, match='negative power'):
+        make_range(3) ** -1
+    with pytest.raises(AssertionError, match='min of an empty array'):
+        array_min(make_range(0))
+
+def test_str():
+    assert str(make_range(3)) == '[0, 1, 2]'
+    assert str(make_range(100)) == '[0, 1, 2, ..., 97, 98, 99]'
+
+# --------------------------------------------------------------------
+# OVERFLOW
+# --------------------------------------------------------------------
+@pytest.mark.parametrize('function, left, right', [
+    (operator.add, [LIMIT, 1], 1),
+    (operator.sub, [-LIMIT, 0], 5),
+    (operator.mul, [2 ** 40, 3], 2 ** 40),
+    (operator.pow, list(range(10)), 30),
+    (operator.mul, [2 ** 70, 1], [2, 2 ** 70]),
+    (operator.floordiv, [2 ** 80, -(2 ** 80)], 3),
+])
+def test_no_overflow(function, left, right):
+    # Like the other integers of GSC, elements never wrap around or raise OverflowError.
+    # Lists are turned into arrays here, so they are stored like the fixture says.
+    if isinstance(right, list):
+        expected = [function(a, b) for a, b in zip(left, right)]
+        right = make_array(*right)
+    else:
+        expected = [function(a, right) for a in left]
+    assert list(function(make_array(*left), right)) == expected
+
+def test_sum_does_not_overflow():
+    assert array_sum(make_range(10) ** 30) == sum(i ** 30 for i in range(10))
+    assert array_sum(make_array(LIMIT, LIMIT)) == 2 * LIMIT
+
+def test_large_bounds():
+    assert list(make_range(2 ** 70, 2 ** 70 + 3)) == [2 ** 70, 2 ** 70 + 1, 2 ** 70 + 2]
+    assert array_max(make_array(-(2 ** 64), 2 ** 65)) == 2 ** 65
+
+def test_results_go_back_to_64_bits(storage):
+    large = make_array(2 ** 64, 2 ** 65)
+    small = large // (2 ** 60)
+    assert list(small) == [16, 32]
+    if storage == 'numpy':
+        assert array_values.is_numpy(small.data)
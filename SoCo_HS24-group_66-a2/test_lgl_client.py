@@ -0,0 +1,126 @@
+import json, os, socket, subprocess, sys
+import pytest
+from lgl_client import send_request
+from trace_format import read_trace
+
+# Tests of lgl_client.py and of lgl_interpreter.py serve, run with: python -m pytest
+# Every test talks to the same server, which is started once in a temporary directory.
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason='The server listens on a Unix socket')
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+EXAMPLE = os.path.join(DIRECTORY, 'example_trace.gsc')
+BACKENDS = ['tree', 'closure', 'stack', 'pycompile']
+
+@pytest.fixture(scope='module')
+def server(tmp_path_factory):
+    socket_path = str(tmp_path_factory.mktemp('serve') / 'lgl.sock')
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(DIRECTORY, 'lgl_interpreter.py'), 'serve', '--socket', socket_path, '--workers', '2'],
+        stdout=subprocess.PIPE, text=True
+    )
+    try:
+        # The server prints this line once it accepts connections
+        assert process.stdout.readline().startswith('SERVING |')
+        yield socket_path
+    finally:
+        process.terminate() # SIGTERM stops the server and removes the socket file
+        process.wait(timeout=10)
+    assert not os.path.exists(socket_path)
+
+def client(socket_path, *args):
+    return subprocess.run(
+        [sys.executable, os.path.join(DIRECTORY, 'lgl_client.py'), '--socket', socket_path, *args],
+        capture_output=True, text=True
+    )
+
+# --------------------------------------------------------------------
+# REQUESTS
+# --------------------------------------------------------------------
+def test_path_request(server):
+    response = send_request(server, {'path': EXAMPLE})
+    assert response['result'] == 18
+    assert response['functions'] == ['helper', 'mathFunc', 'nestedCalc', 'outer', 'inner', 'deepHelper']
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_program_request(server, backend):
+    program = ['sequence', ['set', 'double', ['function', ['x'], ['multiplication', ['get', 'x'], 2]]], ['call', 'double', 21]]
+    response = send_request(server, {'program': program, 'backend': backend})
+    assert response['result'] == 42
+    assert response['functions'] == ['double']
+
+def test_requests_are_isolated(server):
+    assert send_request(server, {'program': ['set', 'x', 5]})['result'] == 5
+    response = send_request(server, {'program': ['get', 'x']})
+    assert response['error'].startswith('NameError')
+
+def test_invalid_program(server):
+    response = send_request(server, {'program': ['seq', 1]})
+    assert response['error'].startswith('ProgramError')
+    assert response['invalid'] == [['$[0]', 'Unknown operation: seq']]
+
+def test_program_error(server):
+    response = send_request(server, {'program': ['division', 1, 0]})
+    assert response['error'] == 'AssertionError: Error: division by 0'
+    assert response['functions'] == []
+
+@pytest.mark.parametrize('request_body, error', [
+    ({'program': 1, 'backend': 'fast'}, 'ValueError: Unknown backend: fast'),
+    ({}, 'ValueError: A request needs a program or a path'),
+    ({'path': '/does/not/exist.gsc'}, 'FileNotFoundError'),
+])
+def test_bad_request(server, request_body, error):
+    assert send_request(server, request_body)['error'].startswith(error)
+
+def test_several_requests_on_one_connection(server):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(server)
+        with connection.makefile('rwb') as stream:
+            stream.write(b'{"program": ["add", 1, 2]}\nnot json\n{"program": ["add", 3, 4]}\n')
+            stream.flush()
+            responses = [json.loads(stream.readline()) for _ in range(3)]
+    assert responses[0]['result'] == 3
+    assert responses[1]['error'].startswith('Invalid request')
+    assert responses[2]['result'] == 7
+
+def test_trace_request(server):
+    response = send_request(server, {'path': EXAMPLE, 'trace': True})
+    names = [func_name for call_id, timestamp, func_name, event, parent_id in response['trace'] if event == 'start']
+    assert len(names) == 6
+    assert response['sample_rate'] == 1
+
+def test_selective_trace_request(server):
+    response = send_request(server, {'path': EXAMPLE, 'trace': {'include': 'inner,deep*'}})
+    names = {func_name for call_id, timestamp, func_name, event, parent_id in response['trace']}
+    assert names == {'inner', 'deepHelper'}
+
+# --------------------------------------------------------------------
+# CLIENT
+# --------------------------------------------------------------------
+def test_client_prints_like_the_interpreter(server):
+    served = client(server, EXAMPLE)
+    local = subprocess.run([sys.executable, os.path.join(DIRECTORY, 'lgl_interpreter.py'), EXAMPLE], capture_output=True, text=True)
+    assert served.returncode == 0
+    assert served.stdout.splitlines() == [line for line in local.stdout.splitlines() if not line.startswith('BUILT-IN')]
+
+def test_client_several_programs(server, tmp_path):
+    failing = tmp_path / 'failing.gsc'
+    failing.write_text(json.dumps(['division', 1, 0]))
+    result = client(server, EXAMPLE, str(failing))
+    assert result.returncode == 1
+    assert f'{EXAMPLE} | RESULT | 18' in result.stdout.splitlines()
+    assert f'{failing} | ERROR | AssertionError: Error: division by 0' in result.stdout.splitlines()
+
+@pytest.mark.parametrize('trace_format', ['csv', 'binary'])
+@pytest.mark.parametrize('extension', ['', '.gz'])
+def test_client_trace_file(server, tmp_path, trace_format, extension):
+    trace_file = str(tmp_path / f'trace.log{extension}')
+    assert client(server, EXAMPLE, '--trace', trace_file, '--trace-format', trace_format).returncode == 0
+    events = list(read_trace(trace_file))
+    assert len(events) == 12
+    assert [event for call_id, timestamp, func_name, event, parent_id in events].count('start') == 6
+
+def test_client_without_server(tmp_path):
+    result = client(str(tmp_path / 'missing.sock'), EXAMPLE)
+    assert result.returncode != 0
+    assert 'No server is listening' in result.stderr
@@ -0,0 +1,263 @@
+import json, os, subprocess, sys, tracemalloc
+from datetime import datetime, timedelta
+import pytest
+from lgl_interpreter import BACKENDS, Memoizer, ProgramError, TraceSink, create_metadata, install_program
+from lgl_interpreter import prepare_program, run_batch_program, validate_program
+from trace_format import EPOCH, read_sample_rate, read_trace
+
+# Tests of lgl_interpreter.py, run with: python -m pytest
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+EXAMPLES = {'example_infix.gsc': 103, 'example_scoping.gsc': 42, 'example_trace.gsc': 18}
+
+def run(program, backend='tree', memo=None, tracer=None):
+    return run_source(json.dumps(program), backend, memo, tracer)
+
+def run_source(source, backend='tree', memo=None, tracer=None):
+    metadata = create_metadata(tracer, memo)
+    return BACKENDS[backend](install_program(prepare_program(source), metadata), metadata)
+
+def read_example(name):
+    with open(os.path.join(DIRECTORY, name)) as f:
+        return f.read()
+
+# --------------------------------------------------------------------
+# BACKENDS
+# --------------------------------------------------------------------
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('example', EXAMPLES)
+def test_examples(backend, example):
+    assert run_source(read_example(example), backend) == EXAMPLES[example]
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('example', EXAMPLES)
+def test_examples_trace_the_same_calls(backend, example, tmp_path):
+    # Every backend records the same calls in the same order, with the same callers
+    def calls(backend):
+        trace_file = tmp_path / f'{backend}.log'
+        tracer = TraceSink(trace_file)
+        try:
+            run_source(read_example(example), backend, tracer=tracer)
+        finally:
+            tracer.close()
+        ids = {}
+        shape = []
+        for call_id, timestamp, func_name, event, parent_id in read_trace(str(trace_file)):
+            ids.setdefault(call_id, len(ids))
+            shape.append((ids[call_id], func_name, event, ids.get(parent_id)))
+        return shape
+    expected = calls('tree')
+    assert expected
+    assert calls(backend) == expected
+
+def test_closure_backend_compiles_called_functions_only():
+    program = ['sequence',
+        ['set', 'f', ['function', ['n'], ['add', ['get', 'n'], 1]]],
+        ['set', 'g', ['function', ['n'], ['substract', ['get', 'n'], 1]]],
+        ['call', 'f', 1],
+    ]
+    metadata = create_metadata()
+    assert BACKENDS['closure'](install_program(prepare_program(json.dumps(program)), metadata), metadata) == 2
+    assert metadata['functions']['f']['compiled'] is not None
+    assert metadata['functions']['g']['compiled'] is None
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_memoized_examples(backend):
+    for example, result in EXAMPLES.items():
+        assert run_source(read_example(example), backend, Memoizer()) == result
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_runtime_errors(backend):
+    with pytest.raises(AssertionError, match='division by 0'):
+        run(['division', 1, ['substract', 2, 2]], backend)
+    with pytest.raises(NameError):
+        run(['get', 'missing'], backend)
+
+# --------------------------------------------------------------------
+# TRACING
+# --------------------------------------------------------------------
+def traced_run(trace_file, *args, **selection):
+    tracer = TraceSink(str(trace_file), *args, **selection)
+    try:
+        run_source(read_example('example_trace.gsc'), tracer=tracer)
+    finally:
+        tracer.close()
+    return list(read_trace(str(trace_file)))
+
+def nanoseconds(moment):
+    return (moment - EPOCH) // timedelta(microseconds=1) * 1000
+
+@pytest.mark.parametrize('name, trace_format', [
+    ('trace.log', 'csv'), ('trace.bin', 'binary'), ('trace.log.gz', 'csv'), ('trace.bin.xz', 'binary'),
+])
+def test_trace_timestamps_are_wall_clock_times(name, trace_format, tmp_path):
+    # The origin is taken when the sink is created, so the first event is not dated to the first flush
+    before = nanoseconds(datetime.now())
+    events = traced_run(tmp_path / name, trace_format, batch_size=4)
+    after = nanoseconds(datetime.now())
+    timestamps = [timestamp for call_id, timestamp, func_name, event, parent_id in events]
+    assert len(timestamps) == 12
+    assert before - 1000 <= timestamps[0] and timestamps[-1] <= after + 1000
+    assert timestamps == sorted(timestamps)
+
+def test_selective_trace(tmp_path):
+    events = traced_run(tmp_path / 'trace.log', include=('inner', 'deep*'))
+    assert {func_name for call_id, timestamp, func_name, event, parent_id in events} == {'inner', 'deepHelper'}
+    events = traced_run(tmp_path / 'depth.log', max_depth=1)
+    assert [func_name for call_id, timestamp, func_name, event, parent_id in events if event == 'start'] == ['outer']
+
+def test_sampled_trace(tmp_path):
+    traced_run(tmp_path / 'trace.log', sample_rate=3)
+    assert read_sample_rate(str(tmp_path / 'trace.log')) == 3
+
+# --------------------------------------------------------------------
+# MEMOIZATION
+# --------------------------------------------------------------------
+def redefinitions(count):
+    # f is redefined `count` times and called with the same argument after every definition
+    steps = []
+    for i in range(1, count + 1):
+        steps.append(['set', 'f', ['function', ['n'], ['add', ['get', 'n'], i]]])
+        steps.append(['call', 'f', 88])
+    return ['sequence', *steps]
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_memoize_redefined_function(backend):
+    program = redefinitions(11)
+    assert run(program, backend, Memoizer()) == run(program, backend) == 99
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_memoize_drops_results_of_redefined_function(backend):
+    memo = Memoizer()
+    run(redefinitions(5), backend, memo)
+    # Only the results of the last definition are left
+    assert len(memo.results) == 1
+    assert list(memo.results.values()) == [93]
+
+@pytest.mark.parametrize('backend', ['tree', 'pycompile'])
+def test_memoize_does_not_lower_recursion_depth(backend):
+    # 200 nested calls fit into the recursion limit of the tree-walker, also if every call is memoized
+    steps = [['set', f'f{i}', ['function', [], ['call', f'f{i + 1}']]] for i in range(200)]
+    program = ['sequence', *steps, ['set', 'f200', ['function', [], 7]], ['call', 'f0']]
+    assert run(program, backend, Memoizer()) == run(program, backend) == 7
+
+# --------------------------------------------------------------------
+# SCOPES
+# --------------------------------------------------------------------
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_local_variable_shadows_global(backend):
+    # y has no slot in f, since it is only set inside an infix string, but it is still local
+    program = ['sequence',
+        ['set', 'y', 1],
+        ['set', 'f', ['function', ['n'], ['sequence', "['set', 'y', 5] + 0", ['get', 'y']]]],
+        ['call', 'f', 0],
+    ]
+    assert run(program, backend) == 5
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_lookup_does_not_change_function(backend):
+    program = ['sequence',
+        ['set', 'k', 3],
+        ['set', 'f', ['function', ['n'], "['get', 'k'] + ['get', 'n']"]],
+        ['call', 'f', 4],
+    ]
+    metadata = create_metadata()
+    prepared = install_program(prepare_program(json.dumps(program)), metadata)
+    assert BACKENDS[backend](prepared, metadata) == 7
+    addresses = metadata['functions']['f']['addresses']
+    assert set(addresses) == {'k', 'n'}
+
+# --------------------------------------------------------------------
+# STACK EVALUATOR
+# --------------------------------------------------------------------
+def test_tail_recursion_runs_in_constant_memory():
+    program = ['sequence',
+        ['set', 'loop', ['function', ['n'], ['if', ['get', 'n'], ['call', 'loop', ['substract', ['get', 'n'], 1]], 0]]],
+        ['call', 'loop', 10000],
+    ]
+    tracemalloc.start()
+    try:
+        assert run(program, 'stack') == 0
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    # Keeping anything per call would take about 700 KB
+    assert peak < 100_000
+
+# --------------------------------------------------------------------
+# PYTHON COMPILER
+# --------------------------------------------------------------------
+def test_untranslatable_function_runs_with_the_tree_walker():
+    program = ['sequence',
+        ['set', 'f', ['function', ['n'], ['add', ['get', 'n'], 1]]],
+        ['set', 'g', ['function', ['n'], ['sequence', ['set', 'h', ['function', [], ['get', 'n']]], ['call', 'h']]]],
+        ['add', ['call', 'f', 1], ['call', 'g', 5]],
+    ]
+    metadata = create_metadata()
+    assert BACKENDS['pycompile'](install_program(prepare_program(json.dumps(program)), metadata), metadata) == 7
+    assert metadata['functions']['f']['native'] is not None
+    assert metadata['functions']['g']['native'] is None # Defines a nested function
+
+# --------------------------------------------------------------------
+# METRICS
+# --------------------------------------------------------------------
+@pytest.mark.parametrize('backend', ['closure', 'stack', 'pycompile'])
+def test_metrics_need_the_tree_walker(backend):
+    command = [sys.executable, os.path.join(DIRECTORY, 'lgl_interpreter.py'), os.path.join(DIRECTORY, 'example_trace.gsc')]
+    process = subprocess.run([*command, '--metrics', '--backend', backend], capture_output=True, text=True)
+    assert process.returncode == 2
+    assert f'cannot be used with --backend {backend}' in process.stderr
+    assert 'RESULT' not in process.stdout
+
+# --------------------------------------------------------------------
+# VALIDATION
+# --------------------------------------------------------------------
+@pytest.mark.parametrize('program, path, message', [
+    (['seq', 1, 2], '$[0]', 'Unknown operation: seq'),
+    (['function', ['x'], 1], '$[0]', 'functions are defined with'),
+    (['add', 1], '$', 'Expected exactly 2 arguments'),
+    (['get', 5], '$', 'Variable name must be a string'),
+    (['sequence', ['set', 'f', ['function', ['x'], 1]], ['call', 'f', 1, 2]], '$[2]', 'expects 1 arguments but got 2'),
+    (['sequence', []], '$[1]', 'Empty expression'),
+    (['sequence', 1.5], '$[1]', 'got float'),
+    ("['get', 'x'] + + 3", '$', 'Invalid infix expression'),
+])
+def test_validate_program_errors(program, path, message):
+    errors = validate_program(program)
+    assert len(errors) == 1
+    assert errors[0][0] == path
+    assert message in errors[0][1]
+
+def test_validate_program_reports_all_errors_in_source_order():
+    program = ['sequence', ['set', 'f', ['function', ['x'], 1]], ['add', 1], ['seq', 2], ['call', 'f']]
+    assert [path for path, message in validate_program(program)] == ['$[2]', '$[3][0]', '$[4]']
+
+def test_validate_program_accepts_calls_of_undefined_functions():
+    # g is never called, so its call of the undefined function h is never reached
+    program = ['sequence', ['set', 'g', ['function', ['x'], ['call', 'h', ['get', 'x']]]], 5]
+    assert validate_program(program) == []
+    assert run(program) == 5
+    with pytest.raises(NameError, match='Function h not found'):
+        run(['sequence', ['call', 'h', 1]])
+
+def test_validate_program_accepts_examples():
+    for example in EXAMPLES:
+        assert validate_program(json.loads(read_example(example))) == []
+
+def test_invalid_program_is_not_run():
+    with pytest.raises(ProgramError) as error:
+        prepare_program(read_example('example_trace_ours.gsc'))
+    assert error.value.errors == [('$[0]', 'Unknown operation: seq')]
+
+# --------------------------------------------------------------------
+# BATCH MODE
+# --------------------------------------------------------------------
+def test_batch_program_with_unwritable_trace(tmp_path):
+    options = {
+        'backend': 'tree', 'trace': True, 'trace_format': 'csv', 'trace_compression': '',
+        'selection': {}, 'optimize': True, 'cache_dir': None,
+    }
+    (tmp_path / 'example_trace.trace').mkdir() # The trace file cannot be opened
+    status = run_batch_program((os.path.join(DIRECTORY, 'example_trace.gsc'), str(tmp_path / 'example_trace'), options))
+    assert status.startswith('ERROR | IsADirectoryError')
+    assert (tmp_path / 'example_trace.out').read_text() == status + '\n'
@@ -0,0 +1,130 @@
+import json, os, pickle
+from concurrent.futures import ProcessPoolExecutor
+from program_cache import INDEX_FILE, ProgramCache
+from lgl_interpreter import create_metadata, do, install_program, prepare_program
+
+# Tests of program_cache.py, run with: python -m pytest
+
+class CountingPrepare:
+    # prepare_program() that counts how often the cache had to call it
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, source):
+        self.calls += 1
+        return prepare_program(source)
+
+def write_program(path, program, mtime_ns=None):
+    with open(path, 'w') as f:
+        json.dump(program, f)
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+    return str(path)
+
+def evaluate(prepared):
+    metadata = create_metadata()
+    return do(install_program(prepared, metadata), metadata)
+
+def read_index(directory):
+    with open(os.path.join(directory, INDEX_FILE), 'rb') as f:
+        return pickle.load(f)
+
+def entry_keys(directory):
+    return {name[:-len('.pickle')] for name in os.listdir(directory) if name.endswith('.pickle') and name != INDEX_FILE}
+
+# --------------------------------------------------------------------
+# LOADING
+# --------------------------------------------------------------------
+def test_unchanged_program_is_prepared_once(tmp_path):
+    path = write_program(tmp_path / 'code.gsc', ['add', 1, 2])
+    cache, prepare = ProgramCache(str(tmp_path / 'cache')), CountingPrepare()
+    assert evaluate(cache.load(path, prepare)) == 3
+    assert evaluate(cache.load(path, prepare)) == 3
+    assert evaluate(ProgramCache(str(tmp_path / 'cache')).load(path, prepare)) == 3
+    assert prepare.calls == 1
+
+def test_changed_program_is_prepared_again(tmp_path):
+    path = write_program(tmp_path / 'code.gsc', ['add', 1, 2], mtime_ns=1_000_000_000)
+    cache, prepare = ProgramCache(str(tmp_path / 'cache')), CountingPrepare()
+    assert evaluate(cache.load(path, prepare)) == 3
+    # Same size and a different modification time
+    write_program(path, ['add', 1, 5], mtime_ns=2_000_000_000)
+    assert evaluate(cache.load(path, prepare)) == 6
+    assert prepare.calls == 2
+
+def test_changed_program_with_the_same_size_and_time(tmp_path):
+    # Only the index is bypassed by the size and the modification time, so this change is not seen
+    path = write_program(tmp_path / 'code.gsc', ['add', 1, 2], mtime_ns=1_000_000_000)
+    cache, prepare = ProgramCache(str(tmp_path / 'cache')), CountingPrepare()
+    cache.load(path, prepare)
+    write_program(path, ['add', 1, 5], mtime_ns=1_000_000_000)
+    assert evaluate(cache.load(path, prepare)) == 3
+    os.utime(path, ns=(3_000_000_000, 3_000_000_000)) # e.g. touch
+    assert evaluate(cache.load(path, prepare)) == 6
+
+def test_touched_program_is_found_by_its_hash(tmp_path):
+    path = write_program(tmp_path / 'code.gsc', ['add', 1, 2], mtime_ns=1_000_000_000)
+    cache, prepare = ProgramCache(str(tmp_path / 'cache')), CountingPrepare()
+    cache.load(path, prepare)
+    os.utime(path, ns=(2_000_000_000, 2_000_000_000))
+    assert evaluate(cache.load(path, prepare)) == 3
+    assert prepare.calls == 1
+    assert read_index(str(tmp_path / 'cache'))[os.path.abspath(path)][1] == 2_000_000_000
+
+def test_copies_share_an_entry(tmp_path):
+    first = write_program(tmp_path / 'first.gsc', ['add', 1, 2])
+    second = write_program(tmp_path / 'second.gsc', ['add', 1, 2])
+    cache, prepare = ProgramCache(str(tmp_path / 'cache')), CountingPrepare()
+    cache.load(first, prepare)
+    cache.load(second, prepare)
+    assert prepare.calls == 1
+    assert len(entry_keys(str(tmp_path / 'cache'))) == 1
+
+def test_options_are_part_of_the_key(tmp_path):
+    path = write_program(tmp_path / 'code.gsc', ['add', 1, 2])
+    cache, prepare = ProgramCache(str(tmp_path / 'cache')), CountingPrepare()
+    cache.load(path, prepare, options=('optimize',))
+    cache.load(path, prepare, options=())
+    assert prepare.calls == 2
+
+def test_unreadable_entry_is_prepared_again(tmp_path):
+    path = write_program(tmp_path / 'code.gsc', ['add', 1, 2])
+    directory = str(tmp_path / 'cache')
+    cache, prepare = ProgramCache(directory), CountingPrepare()
+    cache.load(path, prepare)
+    for key in entry_keys(directory):
+        with open(os.path.join(directory, key + '.pickle'), 'wb') as f:
+            f.write(b'not a pickle')
+    assert evaluate(cache.load(path, prepare)) == 3
+    assert prepare.calls == 2
+
+# --------------------------------------------------------------------
+# EVICTION
+# --------------------------------------------------------------------
+def test_eviction_drops_index_records(tmp_path):
+    directory = str(tmp_path / 'cache')
+    paths = [write_program(tmp_path / f'code{i}.gsc', ['add', i, 2]) for i in range(10)]
+    size = len(pickle.dumps(prepare_program(json.dumps(['add', 0, 2])), pickle.HIGHEST_PROTOCOL))
+    cache = ProgramCache(directory, max_bytes=size * 3)
+    for path in paths:
+        cache.load(path, prepare_program)
+    keys = entry_keys(directory)
+    assert 0 < len(keys) <= 3
+    index = read_index(directory)
+    assert all(record[2] in keys for record in index.values())
+    assert os.path.abspath(paths[-1]) in index
+
+# --------------------------------------------------------------------
+# CONCURRENT RUNS
+# --------------------------------------------------------------------
+def load_in_worker(task):
+    directory, path = task
+    for _ in range(3):
+        ProgramCache(directory).load(path, prepare_program)
+
+def test_concurrent_runs_keep_every_record(tmp_path):
+    directory = str(tmp_path / 'cache')
+    paths = [write_program(tmp_path / f'code{i}.gsc', ['add', i, 2]) for i in range(40)]
+    with ProcessPoolExecutor(max_workers=8) as executor:
+        list(executor.map(load_in_worker, [(directory, path) for path in paths]))
+    assert set(read_index(directory)) == {os.path.abspath(path) for path in paths}
@@ -0,0 +1,97 @@
+import json, os, subprocess, sys
+import pytest
+from lgl_interpreter import TraceSink, create_metadata, do, install_program, prepare_program
+from reporting import PERCENTILES, CallStats, calculate_stats, summary_stats
+
+# Tests of reporting.py, run with: python -m pytest
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+FIB = ['sequence',
+    ['set', 'fib', ['function', ['n'], ['if', ['substract', ['get', 'n'], 1],
+        ['if', ['get', 'n'], ['add', ['call', 'fib', ['substract', ['get', 'n'], 1]], ['call', 'fib', ['substract', ['get', 'n'], 2]]], 0],
+        1]]],
+    ['set', 'twice', ['function', ['n'], ['add', ['call', 'fib', ['get', 'n']], ['call', 'fib', ['get', 'n']]]]],
+    ['call', 'twice', 12],
+]
+
+def write_fib_trace(trace_file, trace_format='csv'):
+    # Small batches, so a binary trace has many blocks to split into shards
+    tracer = TraceSink(str(trace_file), trace_format, batch_size=50)
+    metadata = create_metadata(tracer)
+    try:
+        do(install_program(prepare_program(json.dumps(FIB)), metadata), metadata)
+    finally:
+        tracer.close()
+    return str(trace_file)
+
+def totals(summary):
+    return {name: {slot: getattr(calls, slot) for slot in CallStats.__slots__} for name, calls in summary.items()}
+
+def report(*args):
+    return subprocess.run(
+        [sys.executable, os.path.join(DIRECTORY, 'reporting.py'), *args], capture_output=True, text=True, check=True
+    ).stdout
+
+# --------------------------------------------------------------------
+# SUMMARY
+# --------------------------------------------------------------------
+@pytest.mark.parametrize('trace_format', ['csv', 'binary'])
+def test_summary(trace_format, tmp_path):
+    summary = summary_stats(write_fib_trace(tmp_path / 'trace.log', trace_format))
+    assert summary['twice'].num_calls == 1
+    assert summary['fib'].num_calls == 2 * 465
+    assert summary['twice'].total > summary['fib'].maximum
+
+# --------------------------------------------------------------------
+# PERCENTILES
+# --------------------------------------------------------------------
+def test_percentiles_are_exact_for_short_durations():
+    calls = CallStats()
+    for duration in range(1, 51):
+        calls.add(duration)
+    assert [calls.percentile(fraction) for fraction in PERCENTILES] == [25, 45, 50]
+
+def test_percentiles_are_within_bucket_precision():
+    calls = CallStats()
+    for duration in range(1, 1001):
+        calls.add(duration * 1000)
+    for fraction in PERCENTILES:
+        exact = fraction * 1_000_000
+        assert abs(calls.percentile(fraction) - exact) <= 0.03 * exact
+
+def test_histograms_share_the_same_octaves():
+    fast, slow = CallStats(), CallStats()
+    for duration in (100, 120, 130):
+        fast.add(duration)
+    for duration in (100_000, 1_000_000):
+        slow.add(duration)
+    stats = calculate_stats({'fast': fast, 'slow': slow}, histogram=True, scale=10)
+    assert [stat[1] for stat in stats] == [30, 20]
+    fast_row, slow_row = (stat[-1] for stat in stats)
+    assert len(fast_row) == len(slow_row) == 20 - 7 + 1
+    assert fast_row[0] != ' ' and fast_row[-1] == ' '
+    assert slow_row[0] == ' ' and slow_row[-1] == '@'
+
+# --------------------------------------------------------------------
+# PARALLEL SUMMARY
+# --------------------------------------------------------------------
+@pytest.mark.parametrize('jobs', [2, 3, 8])
+@pytest.mark.parametrize('trace_format', ['csv', 'binary'])
+def test_jobs_match_single_process(trace_format, jobs, tmp_path):
+    trace_file = write_fib_trace(tmp_path / 'trace.log', trace_format)
+    assert totals(summary_stats(trace_file, jobs)) == totals(summary_stats(trace_file))
+
+@pytest.mark.parametrize('trace_format', ['csv', 'binary'])
+def test_jobs_with_compressed_trace(trace_format, tmp_path):
+    trace_file = write_fib_trace(tmp_path / 'trace.log.gz', trace_format)
+    plain_file = write_fib_trace(tmp_path / 'trace.log', trace_format)
+    summary = summary_stats(trace_file, 3)
+    assert {name: calls.num_calls for name, calls in summary.items()} == \
+        {name: calls.num_calls for name, calls in summary_stats(plain_file).items()}
+
+def test_command_line_jobs_match_single_process(tmp_path):
+    trace_file = write_fib_trace(tmp_path / 'trace.bin', 'binary')
+    single = report(trace_file, '--histogram')
+    assert 'fib' in single
+    assert report(trace_file, '--histogram', '--jobs', '3') == single
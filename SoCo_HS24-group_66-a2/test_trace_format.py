@@ -0,0 +1,103 @@
+import gzip, lzma
+import pytest
+from trace_format import TRACE_WRITERS, WALL_CLOCK, BackgroundWriter, open_trace, read_sample_rate, read_trace
+from trace_format import trace_shards
+
+# Tests of trace_format.py, run with: python -m pytest
+
+# (call_id, timestamp_ns, function_name, event, parent_id), with wall-clock timestamps in whole microseconds
+# since the CSV format stores microseconds
+EVENTS = [
+    (1, 1_700_000_000_000_000_000, 'outer', 'start', 0),
+    (2, 1_700_000_000_000_005_000, 'inner', 'start', 1),
+    (3, 1_700_000_000_000_007_000, 'λ_helper', 'start', 2),
+    (3, 1_700_000_000_000_012_000, 'λ_helper', 'stop', 2),
+    (2, 1_700_000_000_000_020_000, 'inner', 'stop', 1),
+    (4, 1_700_000_000_000_021_000, 'inner', 'start', 1),
+    (4, 1_700_000_000_000_030_000, 'inner', 'stop', 1),
+    (1, 1_700_000_000_000_031_000, 'outer', 'stop', 0),
+]
+FORMATS = ['csv', 'binary']
+EXTENSIONS = ['', '.gz', '.xz']
+
+def write_trace(trace_file, trace_format, events, batch_size=3, sample_rate=1, background=False):
+    if trace_format == 'csv':
+        file = open_trace(trace_file, mode='wt', newline='')
+    else:
+        file = open_trace(trace_file, mode='wb')
+    with file:
+        if background:
+            writer = BackgroundWriter(file, TRACE_WRITERS[trace_format], sample_rate, WALL_CLOCK)
+        else:
+            writer = TRACE_WRITERS[trace_format](file, sample_rate, WALL_CLOCK)
+        for start in range(0, len(events), batch_size):
+            writer.write_batch(events[start:start + batch_size])
+        if background:
+            writer.close()
+
+def normalized(events):
+    # CSV traces have hexadecimal call IDs, binary traces integers, and both read a missing parent as None
+    def number(value):
+        return int(value, 16) if isinstance(value, str) else value
+    return [
+        (number(call_id), timestamp, func_name, event, number(parent_id) or 0)
+        for call_id, timestamp, func_name, event, parent_id in events
+    ]
+
+# --------------------------------------------------------------------
+# ROUND-TRIPS
+# --------------------------------------------------------------------
+@pytest.mark.parametrize('extension', EXTENSIONS)
+@pytest.mark.parametrize('trace_format', FORMATS)
+def test_round_trip(trace_format, extension, tmp_path):
+    trace_file = str(tmp_path / f'trace.log{extension}')
+    write_trace(trace_file, trace_format, EVENTS)
+    assert normalized(read_trace(trace_file)) == EVENTS
+    assert read_sample_rate(trace_file) == 1
+
+@pytest.mark.parametrize('extension', ['.gz', '.xz'])
+@pytest.mark.parametrize('trace_format', FORMATS)
+def test_background_writer_round_trip(trace_format, extension, tmp_path):
+    trace_file = str(tmp_path / f'trace.log{extension}')
+    write_trace(trace_file, trace_format, EVENTS, batch_size=1, background=True)
+    assert normalized(read_trace(trace_file)) == EVENTS
+
+@pytest.mark.parametrize('extension', EXTENSIONS)
+@pytest.mark.parametrize('trace_format', FORMATS)
+def test_sample_rate_round_trip(trace_format, extension, tmp_path):
+    trace_file = str(tmp_path / f'trace.log{extension}')
+    write_trace(trace_file, trace_format, EVENTS, sample_rate=10)
+    assert read_sample_rate(trace_file) == 10
+    assert normalized(read_trace(trace_file)) == EVENTS
+
+@pytest.mark.parametrize('trace_format', FORMATS)
+def test_empty_trace(trace_format, tmp_path):
+    trace_file = str(tmp_path / 'trace.log.gz')
+    write_trace(trace_file, trace_format, [], background=True)
+    assert list(read_trace(trace_file)) == []
+
+@pytest.mark.parametrize('extension, module', [('.gz', gzip), ('.xz', lzma)])
+def test_compressed_by_extension(extension, module, tmp_path):
+    trace_file = str(tmp_path / f'trace.log{extension}')
+    write_trace(trace_file, 'csv', EVENTS)
+    with module.open(trace_file, 'rt') as f:
+        assert f.readline().startswith('id,timestamp,function_name,event,parent_id')
+
+# --------------------------------------------------------------------
+# SHARDS
+# --------------------------------------------------------------------
+@pytest.mark.parametrize('count', [1, 2, 3, 20])
+@pytest.mark.parametrize('trace_format', FORMATS)
+def test_shards_cover_the_trace(trace_format, count, tmp_path):
+    trace_file = str(tmp_path / 'trace.log')
+    write_trace(trace_file, trace_format, EVENTS, batch_size=2)
+    events = []
+    for shard in trace_shards(trace_file, count):
+        events.extend(read_trace(trace_file, *shard))
+    assert normalized(events) == EVENTS
+
+@pytest.mark.parametrize('trace_format', FORMATS)
+def test_compressed_trace_is_one_shard(trace_format, tmp_path):
+    trace_file = str(tmp_path / 'trace.log.xz')
+    write_trace(trace_file, trace_format, EVENTS)
+    assert trace_shards(trace_file, 4) == [(None, None, None)]
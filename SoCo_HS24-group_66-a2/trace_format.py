@@ -0,0 +1,341 @@
+import csv, gzip, io, lzma, mmap, os, queue, struct, threading, time
+from datetime import datetime, timedelta
+
+# Trace files come in two formats that are written by lgl_interpreter.py and read by reporting.py.
+# Every reader yields the same events: (call_id, timestamp_ns, function_name, event, parent_id)
+# parent_id is the call ID of the caller, or None for top-level calls and traces written without it
+# A reader can also be limited to a shard of the file, see trace_shards()
+# A trace written with --trace-sample 1/N records one in N calls of every function, the rate is stored in the
+# header of the file and returned by read_sample_rate()
+# Both formats can be compressed, see COMPRESSION
+# Events are timed with time.perf_counter_ns(), a monotonic clock. The writers turn these times into wall-clock
+# times with the origin of the trace, see trace_origin().
+
+##############################################
+################# CSV FORMAT #################
+##############################################
+
+CSV_HEADER = ['id', 'timestamp', 'function_name', 'event', 'parent_id']
+EPOCH = datetime(1970, 1, 1)
+# Origin of events whose timestamps are already wall-clock times, e.g. the events read from another trace
+WALL_CLOCK = (0, EPOCH)
+
+def trace_origin():
+    # The monotonic and the wall-clock time at the same moment, taken when the trace starts.
+    # A wall-clock time is origin_time + (timestamp_ns - origin_ns).
+    return time.perf_counter_ns(), datetime.now()
+
+class CsvTraceWriter:
+    def __init__(self, file, sample_rate=1, origin=None):
+        self.writer = csv.writer(file)
+        # The sample rate is an extra cell of the header, e.g. 1/10, the rows stay the same
+        self.writer.writerow(CSV_HEADER + ([f'1/{sample_rate}'] if sample_rate > 1 else []))
+        self.origin_ns, self.origin_time = origin or trace_origin()
+
+    def write_batch(self, events):
+        for call_id, timestamp_ns, func_name, event, parent_id in events:
+            timestamp = self.origin_time + timedelta(microseconds=(timestamp_ns - self.origin_ns) // 1000)
+            self.writer.writerow([
+                f'{call_id:06x}', timestamp.isoformat(sep=' ', timespec='microseconds'), func_name, event,
+                f'{parent_id:06x}' if parent_id else ''
+            ])
+
+def read_csv_trace(trace_file, start=None, end=None):
+    if start is None:
+        with open_trace(trace_file, 'rt', newline="") as f:
+            reader = csv.reader(f)
+            next(reader) # Skip the header row
+            yield from parse_csv_rows(reader)
+    else:
+        with open(trace_file, 'rb') as f:
+            f.seek(start)
+            yield from parse_csv_rows(csv.reader(line.decode() for line in read_lines(f, end - start)))
+
+def parse_csv_rows(reader):
+    for row in reader:
+        call_id, timestamp, func_name, event = row[:4]
+        parent_id = row[4] if len(row) > 4 and row[4] else None # Older traces have no parent_id column
+        # fromisoformat() is much faster than strptime() and also accepts timestamps without microseconds
+        elapsed = datetime.fromisoformat(timestamp) - EPOCH
+        yield call_id, elapsed // timedelta(microseconds=1) * 1000, func_name, event, parent_id
+
+def read_csv_sample_rate(trace_file):
+    with open_trace(trace_file, 'rt', newline="") as f:
+        header = next(csv.reader(f), [])
+    if len(header) > len(CSV_HEADER) and header[len(CSV_HEADER)].startswith('1/'):
+        return int(header[len(CSV_HEADER)][2:])
+    return 1
+
+def read_lines(f, size):
+    # The lines that start within the next `size` bytes
+    position = 0
+    for line in f:
+        if position >= size:
+            break
+        position += len(line)
+        yield line
+
+def csv_shards(trace_file, count):
+    # Byte ranges of roughly the same size, moved forward to the start of the next line
+    with open(trace_file, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        f.readline() # Skip the header row
+        first = f.tell()
+        bounds = [first]
+        for i in range(1, count):
+            f.seek(max(first + (size - first) * i // count - 1, bounds[-1]))
+            f.readline()
+            bounds.append(max(f.tell(), bounds[-1]))
+        bounds.append(size)
+    return [(start, end, None) for start, end in zip(bounds, bounds[1:])]
+
+##############################################
+############### BINARY FORMAT ################
+##############################################
+
+# A binary trace is a header followed by one block per flushed batch of events:
+#   header:  magic, format version, sample rate (N of --trace-sample 1/N, 1 if every call is recorded)
+#   block:   number of new names, number of records
+#            the new names of the string table (length + utf-8 bytes)
+#            fixed-width records: call id, parent call id (0 for none), index in the string table,
+#            event, wall-clock timestamp in ns since 1970 (like the timestamps read from a CSV trace)
+# The string table is spread over the blocks, a name is stored in the first block that uses it.
+# Version 1 records had no parent call id and versions 1 and 2 had no sample rate, they can still be read.
+MAGIC = b'LGLTRACE'
+VERSION = 3
+HEADERS = {
+    1: struct.Struct('<8sH'),
+    2: struct.Struct('<8sH'),
+    3: struct.Struct('<8sHI'),
+}
+HEADER = HEADERS[VERSION]
+BLOCK = struct.Struct('<II')
+NAME_LENGTH = struct.Struct('<H')
+RECORDS = {
+    1: struct.Struct('<QIIq'),
+    2: struct.Struct('<QQIIq'),
+    3: struct.Struct('<QQIIq'),
+}
+RECORD = RECORDS[VERSION]
+EVENTS = ('start', 'stop')
+EVENT_CODES = {event: code for code, event in enumerate(EVENTS)}
+
+class BinaryTraceWriter:
+    def __init__(self, file, sample_rate=1, origin=None):
+        self.file = file
+        self.names = {} # {function name: index in the string table}
+        self.file.write(HEADER.pack(MAGIC, VERSION, sample_rate))
+        origin_ns, origin_time = origin or trace_origin()
+        self.offset_ns = (origin_time - EPOCH) // timedelta(microseconds=1) * 1000 - origin_ns
+
+    def write_batch(self, events):
+        new_names = bytearray()
+        name_count = len(self.names)
+        records = bytearray()
+        for call_id, timestamp_ns, func_name, event, parent_id in events:
+            index = self.names.get(func_name)
+            if index is None:
+                index = self.names[func_name] = len(self.names)
+                encoded = func_name.encode()
+                new_names += NAME_LENGTH.pack(len(encoded)) + encoded
+            records += RECORD.pack(call_id, parent_id, index, EVENT_CODES[event], timestamp_ns + self.offset_ns)
+        self.file.write(BLOCK.pack(len(self.names) - name_count, len(events)) + new_names + records)
+
+def read_binary_trace(trace_file, start=None, end=None, names=None):
+    # A shard gets the complete string table from binary_shards(), so it only skips the names in its blocks
+    collect_names = names is None
+    if collect_names:
+        names = []
+    with open(trace_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        version = check_header(data)
+        record = RECORDS[version]
+        if start is None:
+            start, end = HEADERS[version].size, len(data)
+
+        offset = start
+        while offset < end:
+            name_count, record_count = BLOCK.unpack_from(data, offset)
+            offset += BLOCK.size
+            for _ in range(name_count):
+                (length,) = NAME_LENGTH.unpack_from(data, offset)
+                offset += NAME_LENGTH.size
+                if collect_names:
+                    names.append(data[offset:offset + length].decode())
+                offset += length
+
+            records_end = offset + record_count * record.size
+            if records_end > len(data):
+                raise ValueError(f"Binary trace {trace_file} is truncated")
+            # The records are unpacked straight from the mapped file, without parsing any text
+            with memoryview(data)[offset:records_end] as records:
+                yield from unpack_records(records, version, names)
+            offset = records_end
+
+def read_binary_stream(trace_file):
+    # A compressed trace cannot be mapped, it is decompressed and parsed one block at a time instead
+    names = []
+    with open_trace(trace_file, 'rb') as f:
+        header = f.read(HEADERS[1].size)
+        version = check_header(header)
+        f.read(HEADERS[version].size - len(header))
+        record = RECORDS[version]
+        while block := f.read(BLOCK.size):
+            name_count, record_count = BLOCK.unpack(read_exactly(f, BLOCK.size, block, trace_file))
+            for _ in range(name_count):
+                (length,) = NAME_LENGTH.unpack(read_exactly(f, NAME_LENGTH.size, b'', trace_file))
+                names.append(read_exactly(f, length, b'', trace_file).decode())
+            records = read_exactly(f, record_count * record.size, b'', trace_file)
+            yield from unpack_records(records, version, names)
+
+def read_exactly(f, size, data, trace_file):
+    # `data` is what was already read, the rest of the `size` bytes is read from f
+    data += f.read(size - len(data))
+    if len(data) < size:
+        raise ValueError(f"Binary trace {trace_file} is truncated")
+    return data
+
+def unpack_records(records, version, names):
+    if version > 1:
+        for call_id, parent_id, name_index, event, timestamp_ns in RECORDS[version].iter_unpack(records):
+            yield call_id, timestamp_ns, names[name_index], EVENTS[event], parent_id or None
+    else:
+        for call_id, name_index, event, timestamp_ns in RECORDS[version].iter_unpack(records):
+            yield call_id, timestamp_ns, names[name_index], EVENTS[event], None
+
+def check_header(data):
+    magic, version = HEADERS[1].unpack_from(data, 0)
+    if version not in RECORDS:
+        raise ValueError(f"Unsupported binary trace version {version}")
+    return version
+
+def read_binary_sample_rate(trace_file):
+    with open_trace(trace_file, 'rb') as f:
+        data = f.read(HEADER.size)
+    version = check_header(data)
+    return HEADERS[version].unpack_from(data, 0)[2] if version >= 3 else 1
+
+def binary_shards(trace_file, count):
+    # Groups of whole blocks of roughly the same size, found by jumping from block header to block header
+    names = []
+    blocks = []
+    with open(trace_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        version = check_header(data)
+        record = RECORDS[version]
+        first = offset = HEADERS[version].size
+        while offset < len(data):
+            blocks.append(offset)
+            name_count, record_count = BLOCK.unpack_from(data, offset)
+            offset += BLOCK.size
+            for _ in range(name_count):
+                (length,) = NAME_LENGTH.unpack_from(data, offset)
+                offset += NAME_LENGTH.size
+                names.append(data[offset:offset + length].decode())
+                offset += length
+            offset += record_count * record.size
+        size = len(data)
+
+    bounds = [first]
+    for i in range(1, count):
+        target = first + (size - first) * i // count
+        bounds.append(max(next((block for block in blocks if block >= target), size), bounds[-1]))
+    bounds.append(size)
+    return [(start, end, names) for start, end in zip(bounds, bounds[1:])]
+
+##############################################
+################ COMPRESSION #################
+##############################################
+
+# A trace whose file name ends with one of these extensions is compressed while it is written and decompressed
+# while it is read, e.g. --trace trace_file.log.gz. {extension: (open function, options for writing)}
+# The levels are lower than the defaults: they compress a trace almost as well and several times faster.
+COMPRESSORS = {
+    '.gz': (gzip.open, {'compresslevel': 6}),
+    '.xz': (lzma.open, {'preset': 1}),
+}
+
+def is_compressed(trace_file):
+    return os.path.splitext(trace_file)[1] in COMPRESSORS
+
+def open_trace(trace_file, mode, newline=None):
+    # Like open(), but compressed or decompressed according to the extension of the file
+    compressor = COMPRESSORS.get(os.path.splitext(trace_file)[1])
+    if compressor is None:
+        return open(trace_file, mode, newline=newline)
+    open_function, options = compressor
+    return open_function(trace_file, mode, newline=newline, **(options if mode[0] == 'w' else {}))
+
+class BackgroundWriter:
+    # Writes a trace to a compressed file from a separate thread, so that the program does not wait while a batch
+    # is compressed. The events are formatted by `writer_class` into a buffer in memory, only the compression and
+    # the writing happen in the thread, because zlib and lzma release the GIL while they work.
+    def __init__(self, file, writer_class, sample_rate=1, origin=None, max_batches=8):
+        self.file = file
+        self.staging = io.StringIO(newline='') if isinstance(file, io.TextIOBase) else io.BytesIO()
+        self.writer = writer_class(self.staging, sample_rate, origin)
+        self.batches = queue.Queue(max_batches) # A program that traces faster than the thread writes has to wait
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='lgl-trace-writer', daemon=True)
+        self.thread.start()
+
+    def write_batch(self, events):
+        if self.error is not None:
+            raise self.error
+        self.writer.write_batch(events)
+        self.hand_over()
+
+    def hand_over(self):
+        data = self.staging.getvalue()
+        self.staging.seek(0)
+        self.staging.truncate()
+        if data:
+            self.batches.put(data)
+
+    def run(self):
+        while (data := self.batches.get()) is not None:
+            if self.error is None: # After an error, the batches are only taken off the queue
+                try:
+                    self.file.write(data)
+                except Exception as error:
+                    self.error = error
+
+    def close(self):
+        # Waits until everything is written, the errors of the thread are raised here
+        self.hand_over() # The header of a trace without events
+        self.batches.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+##############################################
+################## DETECTION #################
+##############################################
+
+TRACE_WRITERS = {
+    'csv': CsvTraceWriter,
+    'binary': BinaryTraceWriter,
+}
+
+def is_binary_trace(trace_file):
+    with open_trace(trace_file, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def read_trace(trace_file, start=None, end=None, names=None):
+    if is_binary_trace(trace_file):
+        if is_compressed(trace_file):
+            return read_binary_stream(trace_file)
+        return read_binary_trace(trace_file, start, end, names)
+    return read_csv_trace(trace_file, start, end)
+
+def read_sample_rate(trace_file):
+    # N for a trace that recorded one in N calls, the counts and total times of the calls are scaled by it
+    if is_binary_trace(trace_file):
+        return read_binary_sample_rate(trace_file)
+    return read_csv_sample_rate(trace_file)
+
+def trace_shards(trace_file, count):
+    # Splits the trace into `count` shards that can be read independently with read_trace(trace_file, *shard)
+    if is_compressed(trace_file): # The position of an event in the decompressed data is not known in advance
+        return [(None, None, None)]
+    if is_binary_trace(trace_file):
+        return binary_shards(trace_file, count)
+    return csv_shards(trace_file, count)